@@ -0,0 +1,130 @@
+import multiprocessing
+
+import torch
+
+
+class SampleCache(object):
+    # Byte-budgeted LRU cache of loaded sequences, indexed by sample index.
+    # Everything lives in shared-memory tensors, so DataLoader workers forked (or spawned)
+    # from the process that built it all read and fill the same copy.
+    # Sequences are stored as raw bytes in fixed-size pages chained through next_page, so
+    # variable-length samples never fragment the budget and a hit comes back with the dtype
+    # the loader produced. Recency is a doubly linked list (lru_prev / lru_next, oldest at
+    # HEAD); eviction frees the pages of the head sample until the new one fits.
+    HEAD, TAIL, FREE, HITS, MISSES, EVICTIONS = range(6)
+    DTYPES = (torch.float32, torch.float64, torch.float16, torch.bfloat16, torch.int64, torch.int32, torch.int16,
+              torch.int8, torch.uint8, torch.bool)
+
+    def __init__(self, n_samples, budget_bytes, page_bytes=64 << 10, mp_context=None):
+        self.page_bytes = max(1, page_bytes)
+        self.n_pages = max(1, budget_bytes // self.page_bytes)
+        self.pages = torch.zeros((self.n_pages, self.page_bytes), dtype=torch.uint8).share_memory_()
+        self.next_page = torch.full((self.n_pages,), -1, dtype=torch.int64).share_memory_()
+        self.free_pages = torch.arange(self.n_pages, dtype=torch.int64).share_memory_()
+        self.first_page = torch.full((n_samples,), -1, dtype=torch.int64).share_memory_()
+        self.shape = torch.zeros((n_samples, 2), dtype=torch.int64).share_memory_()
+        self.dtype = torch.zeros((n_samples,), dtype=torch.int8).share_memory_()
+        self.lru_prev = torch.full((n_samples,), -1, dtype=torch.int64).share_memory_()
+        self.lru_next = torch.full((n_samples,), -1, dtype=torch.int64).share_memory_()
+        self.counters = torch.zeros(6, dtype=torch.int64).share_memory_()
+        self.counters[self.HEAD] = self.counters[self.TAIL] = -1
+        self.counters[self.FREE] = self.n_pages
+        # must come from the same start method as the DataLoader workers (fork by default on Linux)
+        self.lock = multiprocessing.get_context(mp_context).Lock()
+
+    def _unlink(self, index):
+        prev, nxt = int(self.lru_prev[index]), int(self.lru_next[index])
+        if prev >= 0:
+            self.lru_next[prev] = nxt
+        else:
+            self.counters[self.HEAD] = nxt
+        if nxt >= 0:
+            self.lru_prev[nxt] = prev
+        else:
+            self.counters[self.TAIL] = prev
+        self.lru_prev[index] = self.lru_next[index] = -1
+
+    def _append(self, index):
+        # most recently used goes to the tail
+        tail = int(self.counters[self.TAIL])
+        self.lru_prev[index], self.lru_next[index] = tail, -1
+        if tail >= 0:
+            self.lru_next[tail] = index
+        else:
+            self.counters[self.HEAD] = index
+        self.counters[self.TAIL] = index
+
+    def _chain(self, page):
+        chain = []
+        while page >= 0:
+            chain.append(page)
+            page = int(self.next_page[page])
+        return chain
+
+    def _evict(self, index):
+        chain = self._chain(int(self.first_page[index]))
+        n_free = int(self.counters[self.FREE])
+        self.free_pages[n_free:n_free + len(chain)] = torch.tensor(chain, dtype=torch.int64)
+        self.counters[self.FREE] = n_free + len(chain)
+        self.first_page[index] = -1
+        self._unlink(index)
+        self.counters[self.EVICTIONS] += 1
+
+    def get(self, index):
+        with self.lock:
+            page = int(self.first_page[index])
+            if page < 0:
+                self.counters[self.MISSES] += 1
+                return None
+            self.counters[self.HITS] += 1
+            self._unlink(index)
+            self._append(index)
+            rows, cols = self.shape[index].tolist()
+            dtype = self.DTYPES[int(self.dtype[index])]
+            n, pb = rows * cols * dtype.itemsize, self.page_bytes
+            raw = torch.empty(n, dtype=torch.uint8)
+            for k, p in enumerate(self._chain(page)):
+                raw[k * pb:(k + 1) * pb] = self.pages[p, :min(pb, n - k * pb)]
+        return raw.view(dtype).view(rows, cols)
+
+    def put(self, index, lm):
+        lm = torch.as_tensor(lm).contiguous()
+        if lm.dtype not in self.DTYPES:
+            return False
+        raw = lm.view(-1).view(torch.uint8)
+        n, pb = raw.numel(), self.page_bytes
+        n_needed = max(1, -(-n // pb))
+        if n_needed > self.n_pages:
+            return False
+        with self.lock:
+            if self.first_page[index] >= 0:
+                return True
+            while self.counters[self.FREE] < n_needed:
+                self._evict(int(self.counters[self.HEAD]))
+            n_free = int(self.counters[self.FREE])
+            chain = self.free_pages[n_free - n_needed:n_free].tolist()
+            self.counters[self.FREE] = n_free - n_needed
+            for k, p in enumerate(chain):
+                chunk = raw[k * pb:(k + 1) * pb]
+                self.pages[p, :chunk.numel()] = chunk
+                self.next_page[p] = chain[k + 1] if k + 1 < len(chain) else -1
+            self.first_page[index] = chain[0]
+            rows = lm.shape[0] if lm.dim() else 1
+            self.shape[index, 0], self.shape[index, 1] = rows, lm.numel() // max(1, rows)
+            self.dtype[index] = self.DTYPES.index(lm.dtype)
+            self._append(index)
+        return True
+
+    def stats(self):
+        hits, misses = int(self.counters[self.HITS]), int(self.counters[self.MISSES])
+        used = (self.n_pages - int(self.counters[self.FREE])) * self.page_bytes
+        return {'hits': hits, 'misses': misses, 'evictions': int(self.counters[self.EVICTIONS]),
+                'cached': int((self.first_page >= 0).sum()), 'used_bytes': used,
+                'budget_bytes': self.n_pages * self.page_bytes}
+
+    def report(self):
+        s = self.stats()
+        lookups = max(1, s['hits'] + s['misses'])
+        return 'cache hits {} misses {} hit_rate {:.2f}% evictions {} cached {} used {:.1f}/{:.1f} MB'.format(
+            s['hits'], s['misses'], 100. * s['hits'] / lookups, s['evictions'], s['cached'],
+            s['used_bytes'] / 2. ** 20, s['budget_bytes'] / 2. ** 20)
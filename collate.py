@@ -0,0 +1,97 @@
+import torch
+from torch.nn.utils.rnn import PackedSequence
+
+from dataset import QuantizedSequence
+
+
+def _as_tensor(lm):
+    return lm if torch.is_tensor(lm) else torch.as_tensor(lm)
+
+
+def _pin(pin_memory):
+    return pin_memory and torch.cuda.is_available()
+
+
+def pad_batch(lms, lens, pin_memory=False, dtype=torch.float32):
+    # batch x seq x feature, every sequence is written once and only the padded tail is zeroed
+    out = torch.empty((len(lms), max(lens), lms[0].shape[1]), dtype=dtype, pin_memory=_pin(pin_memory))
+    for i, lm in enumerate(lms):
+        out[i, :lens[i]].copy_(lm)
+        out[i, lens[i]:].zero_()
+    return out
+
+
+def pack_batch(lms, lens, pin_memory=False, dtype=torch.float32):
+    # Builds the PackedSequence directly: frame t of the k-th longest sequence lives at
+    # row offsets[t] + k of the time-major packed data, so each sequence is one index_copy_.
+    lengths = torch.as_tensor(lens, dtype=torch.int64)
+    sorted_lengths, sorted_indices = torch.sort(lengths, descending=True)
+    batch_sizes = (sorted_lengths.unsqueeze(0) > torch.arange(int(sorted_lengths[0])).unsqueeze(1)).sum(1)
+    offsets = torch.cumsum(batch_sizes, 0) - batch_sizes
+    out = torch.empty((int(lengths.sum()), lms[0].shape[1]), dtype=dtype, pin_memory=_pin(pin_memory))
+    for k, i in enumerate(sorted_indices.tolist()):
+        out.index_copy_(0, offsets[:lens[i]] + k, lms[i])
+    unsorted_indices = torch.empty_like(sorted_indices)
+    unsorted_indices[sorted_indices] = torch.arange(len(lens))
+    return PackedSequence(out, batch_sizes, sorted_indices, unsorted_indices), lengths
+
+
+def dequantize(raw, scale, offset, pin_memory=False):
+    # float32 = raw * scale + offset for a whole batch in two ops (scale / offset broadcast per sequence)
+    out = torch.empty(raw.shape, pin_memory=_pin(pin_memory))
+    torch.mul(raw, scale, out=out)
+    return out.add_(offset)
+
+
+def dequantize_padded(raw, lens, scale, offset, pin_memory=False):
+    out = dequantize(raw, scale.view(-1, 1, 1), offset.view(-1, 1, 1), pin_memory)
+    for i in range(len(lens)):
+        out[i, lens[i]:].zero_()
+    return out
+
+
+def dequantize_packed(packed, scale, offset, pin_memory=False):
+    # row r at time t belongs to the (r - offsets[t])-th longest sequence
+    batch_sizes = packed.batch_sizes
+    offsets = torch.cumsum(batch_sizes, 0) - batch_sizes
+    rows = torch.arange(packed.data.shape[0]) - torch.repeat_interleave(offsets, batch_sizes)
+    seq = packed.sorted_indices[rows]
+    data = dequantize(packed.data, scale[seq].unsqueeze(1), offset[seq].unsqueeze(1), pin_memory)
+    return packed._replace(data=data)
+
+
+class PadCollate(object):
+    # Shared collate_fn for LandmarkList-style items (lm, target, length[, path, ...]).
+    # padded: returns (batch x seq x feature, targets, lengths, ...) sorted by length like the old pad_collate.
+    # packed: returns (PackedSequence, targets, length tensor, ...) in dataset order; the recurrent
+    #         models take it as is, no sort or pack_padded_sequence needed.
+    def __init__(self, packed=False, pin_memory=False, sort=True):
+        self.packed = packed
+        self.pin_memory = pin_memory
+        self.sort = sort
+
+    def __call__(self, batch):
+        if self.sort and not self.packed:
+            batch.sort(key=lambda x: x[2], reverse=True)
+        fields = list(zip(*batch))
+        tgs, lens = fields[1], fields[2]
+        if isinstance(fields[0][0], QuantizedSequence):
+            # reduced-precision samples are collated in their storage dtype and dequantized per batch
+            scale = torch.tensor([lm.scale for lm in fields[0]], dtype=torch.float32)
+            offset = torch.tensor([lm.offset for lm in fields[0]], dtype=torch.float32)
+            lms = [_as_tensor(lm.data) for lm in fields[0]]
+            if self.packed:
+                lms, lens = pack_batch(lms, lens, dtype=lms[0].dtype)
+                lms = dequantize_packed(lms, scale, offset, self.pin_memory)
+            else:
+                lms = dequantize_padded(pad_batch(lms, lens, dtype=lms[0].dtype), lens, scale, offset, self.pin_memory)
+            return (lms, tgs, lens) + tuple(fields[3:])
+        lms = [_as_tensor(lm) for lm in fields[0]]
+        if self.packed:
+            lms, lens = pack_batch(lms, lens, self.pin_memory)
+        else:
+            lms = pad_batch(lms, lens, self.pin_memory)
+        return (lms, tgs, lens) + tuple(fields[3:])
+
+
+pad_collate = PadCollate()
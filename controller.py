@@ -0,0 +1,81 @@
+import time
+
+
+class TrainController(object):
+    # Decides when a training loop evaluates and when it stops:
+    # - evaluate every eval_every_epochs epochs and/or every eval_every_steps optimizer steps (0 disables each)
+    # - stop after `patience` evaluations in a row without improving `monitor` by more than min_delta
+    # - stop once time_budget seconds of wall clock have passed
+    # patience=0 / time_budget=0 never stop early.
+
+    def __init__(self, eval_every_epochs=1, eval_every_steps=0, patience=0, monitor='valid_acc', min_delta=0.,
+                 time_budget=0):
+        if monitor not in ('valid_acc', 'valid_loss'):
+            raise ValueError('monitor must be valid_acc or valid_loss, got {!r}'.format(monitor))
+        self.eval_every_epochs = eval_every_epochs
+        self.eval_every_steps = eval_every_steps
+        self.patience = patience
+        self.monitor = monitor
+        self.min_delta = min_delta
+        self.time_budget = time_budget
+        self.start = time.time()
+        self.epoch, self.step = 0, 0
+        self.best, self.best_step = None, None
+        self.bad_evals = 0
+        self.n_evals = 0
+        self.last_eval_step = 0
+        self.stop_reason = None
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def _check_time(self):
+        if self.time_budget and self.stop_reason is None and self.elapsed() > self.time_budget:
+            self.stop_reason = 'time budget of {:.0f}s used up'.format(self.time_budget)
+
+    def after_step(self):
+        # call after every optimizer step; True when a step-based evaluation is due
+        self.step += 1
+        self._check_time()
+        return bool(self.eval_every_steps) and self.step % self.eval_every_steps == 0
+
+    def after_epoch(self):
+        # call at the end of every epoch; True when an epoch-based evaluation is due
+        self.epoch += 1
+        self._check_time()
+        return bool(self.eval_every_epochs) and self.epoch % self.eval_every_epochs == 0
+
+    def update(self, valid_acc, valid_loss):
+        # record one evaluation; True when it is the best so far (time to save the model)
+        self.n_evals += 1
+        self.last_eval_step = self.step
+        value = valid_acc if self.monitor == 'valid_acc' else valid_loss
+        if self.best is None:
+            # as before the controller, a first valid_acc of 0 is not worth a checkpoint
+            improved = value > 0 if self.monitor == 'valid_acc' else True
+        elif self.monitor == 'valid_acc':
+            improved = value > self.best + self.min_delta
+        else:
+            improved = value < self.best - self.min_delta
+        if improved:
+            self.best, self.best_step = value, self.step
+            self.bad_evals = 0
+        else:
+            self.bad_evals += 1
+            if self.patience and self.bad_evals >= self.patience and self.stop_reason is None:
+                self.stop_reason = 'no {} improvement in {} evaluations'.format(self.monitor, self.bad_evals)
+        self._check_time()
+        return improved
+
+    @property
+    def stopped(self):
+        return self.stop_reason is not None
+
+    def pending_eval(self):
+        # steps were taken since the last evaluation
+        return self.step > self.last_eval_step
+
+    def report(self):
+        return 'stopped: {} after {} epochs, {} steps, {} evaluations, {:.0f}s; best {} {} at step {}'.format(
+            self.stop_reason or 'max epochs reached', self.epoch, self.step, self.n_evals, self.elapsed(),
+            self.monitor, self.best, self.best_step)
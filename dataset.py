@@ -4,11 +4,16 @@ from __future__ import print_function
 
 import torch.utils.data as data
 
+import collections
 import os
 import os.path
 import re
 import torch
 import pickle
+import random
+import numpy as np
+
+from cache import SampleCache
 
 
 def default_loader(path):
@@ -17,6 +22,25 @@ def default_loader(path):
     fp.close()
     return lm_list
 
+
+# Sequence exported by quantize_data.py: lm = data * scale + offset, data stored as float16
+# (scale 1, offset 0) or int16 with a per-file scale and offset. collate.PadCollate dequantizes
+# whole batches at once.
+class QuantizedSequence(collections.namedtuple('QuantizedSequence', ['data', 'scale', 'offset'])):
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def dequantize(self):
+        return self.data.float() * self.scale + self.offset
+
+
+def quantized_loader(path):
+    with open(path, 'rb') as fp:
+        lm = pickle.load(fp)
+    return QuantizedSequence(torch.from_numpy(lm['data']), float(lm['scale']), float(lm['offset']))
+
+
 def default_list_reader(fileList):
     lmList = []
     with open(fileList, 'r') as file:
@@ -28,16 +52,69 @@ def default_list_reader(fileList):
     return lmList
 
 
+class CompactList(object):
+    # Read-only (path, label) list kept in three numpy arrays (utf-8 path bytes, offsets, int8 labels)
+    # instead of one Python tuple and two objects per sample. Forked DataLoader workers then never
+    # touch per-sample refcounts, so the pages stay shared and worker RSS does not grow with the list.
+    def __init__(self, lmList):
+        encoded, labels = [], []
+        for lmPath, target in lmList:
+            encoded.append(lmPath.encode('utf-8'))
+            labels.append(target)
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=self.offsets[1:])
+        self.path_bytes = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        self.labels = np.array(labels, dtype=np.int8)
+
+    def path(self, index):
+        return self.path_bytes[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, index):
+        return self.path(index), int(self.labels[index])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 class LandmarkList(data.Dataset):
-    def __init__(self, root, fileList, transform=None, list_reader=default_list_reader, loader=default_loader):
+    def __init__(self, root, fileList, transform=None, list_reader=default_list_reader, loader=default_loader, cache_bytes=0,
+                 manifest=None, refresh_manifest=False):
         self.root      = root
-        self.lmList   = list_reader(fileList)
+        self.lengths   = None
+        if manifest is not None:
+            # manifest.py index: loads without unpickling the data files; it is (re)built when missing,
+            # older than fileList, out of date with a data file or on request, and then only new or
+            # changed files are rescanned
+            from manifest import build_manifest, load_manifest, manifest_is_stale
+            if refresh_manifest or manifest_is_stale(root, fileList, manifest):
+                build_manifest(root, fileList, manifest, list_reader=list_reader, loader=loader)
+            index = load_manifest(manifest)
+            self.lmList  = CompactList(zip(index['paths'].tolist(), index['labels'].tolist()))
+            self.lengths = index['num_frames']
+        else:
+            self.lmList  = CompactList(list_reader(fileList))
         self.transform = transform
         self.loader    = loader
+        # optional shared-memory LRU of loader outputs (in their own dtype), kept across epochs and workers
+        self.cache     = SampleCache(len(self.lmList), cache_bytes) if cache_bytes else None
+
+    def _load(self, index, lmPath):
+        lm = self.cache.get(index) if self.cache is not None else None
+        if lm is None:
+            lm = self.loader(os.path.join(self.root, lmPath))
+            if self.cache is not None and not isinstance(lm, QuantizedSequence):
+                # a miss hands back the same tensor type a later hit will
+                lm = torch.as_tensor(lm)
+                self.cache.put(index, lm)
+        return lm
 
     def __getitem__(self, index):
         lmPath, target = self.lmList[index]
-        lm = self.loader(os.path.join(self.root, lmPath))
+        lm = self._load(index, lmPath)
         if self.transform is not None:
             lm = self.transform(lm)
         return lm, target, lm.shape[0]
@@ -46,19 +123,140 @@ class LandmarkList(data.Dataset):
         return len(self.lmList)
 
 
-class LandmarkListTest(data.Dataset):
-    def __init__(self, root, fileList, transform=None, list_reader=default_list_reader, loader=default_loader):
-        self.root      = root
-        self.lmList   = list_reader(fileList)
-        self.transform = transform
-        self.loader    = loader
-
+class LandmarkListTest(LandmarkList):
     def __getitem__(self, index):
         lmPath, target = self.lmList[index]
-        lm = self.loader(os.path.join(self.root, lmPath))
+        lm = self._load(index, lmPath)
         if self.transform is not None:
             lm = self.transform(lm)
         return lm, target, lm.shape[0], lmPath
 
+
+class LandmarkStream(data.IterableDataset):
+    # Streaming LandmarkList for lists too large to index: the list file is read line by line,
+    # line i goes to shard i % (world_size * num_workers) so every DataLoader worker on every rank
+    # reads a disjoint, deterministic part of it in file order, and shuffling is approximated with
+    # a bounded buffer of shuffle_buffer samples. Call set_epoch() each epoch to reshuffle.
+    def __init__(self, root, fileList, transform=None, loader=default_loader, shuffle_buffer=0, seed=0,
+                 rank=None, world_size=None, return_path=False):
+        self.root           = root
+        self.fileList       = fileList
+        self.transform      = transform
+        self.loader         = loader
+        self.shuffle_buffer = shuffle_buffer
+        self.seed           = seed
+        self.rank           = rank
+        self.world_size     = world_size
+        self.return_path    = return_path
+        self.epoch          = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _shard(self):
+        rank, world_size = self.rank, self.world_size
+        if rank is None or world_size is None:
+            if torch.distributed.is_available() and torch.distributed.is_initialized():
+                rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+            else:
+                rank, world_size = 0, 1
+        worker = data.get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def _samples(self, shard, n_shards):
+        with open(self.fileList, 'r') as file:
+            i = 0
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                if i % n_shards == shard:
+                    lmPath, target = line[:-2].strip(), int(line[-1])
+                    lm = self.loader(os.path.join(self.root, lmPath))
+                    if self.transform is not None:
+                        lm = self.transform(lm)
+                    if self.return_path:
+                        yield lm, target, lm.shape[0], lmPath
+                    else:
+                        yield lm, target, lm.shape[0]
+                i += 1
+
+    def __iter__(self):
+        shard, n_shards = self._shard()
+        samples = self._samples(shard, n_shards)
+        if self.shuffle_buffer <= 1:
+            return samples
+        return self._shuffled(samples, random.Random('{}-{}-{}'.format(self.seed, self.epoch, shard)))
+
+    def _shuffled(self, samples, rng):
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+
+# Packed shards written by pack_dataset.py: every sequence is stored row-major in
+# one of a few flat binary files and located through index.npz (shard, offset, length).
+PACK_INDEX = 'index.npz'
+
+
+def shard_name(shard):
+    return 'shard_{:05d}.bin'.format(shard)
+
+
+class PackedLandmarkList(data.Dataset):
+    def __init__(self, root, transform=None):
+        self.root      = root
+        self.transform = transform
+        index = np.load(os.path.join(root, PACK_INDEX))
+        self.paths     = index['paths']
+        self.labels    = index['labels']
+        self.shard     = index['shard']
+        self.offset    = index['offset']
+        self.lengths   = index['length']
+        self.dim       = int(index['dim'])
+        self.dtype     = np.dtype(str(index['dtype']))
+        # memmaps are opened lazily so every DataLoader worker maps the shards itself
+        self.shards    = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def _open_shards(self):
+        n_shards = int(self.shard.max()) + 1 if len(self.shard) else 0
+        # copy-on-write mapping: views are writable for torch.from_numpy, the files are never touched
+        self.shards = [np.memmap(os.path.join(self.root, shard_name(i)), dtype=self.dtype, mode='c')
+                       for i in range(n_shards)]
+
+    def _sequence(self, index):
+        if self.shards is None:
+            self._open_shards()
+        start = int(self.offset[index]) * self.dim
+        length = int(self.lengths[index])
+        lm = torch.from_numpy(self.shards[self.shard[index]][start:start + length * self.dim].reshape(length, self.dim))
+        if self.transform is not None:
+            lm = self.transform(lm)
+        return lm
+
+    def __getitem__(self, index):
+        lm = self._sequence(index)
+        return lm, int(self.labels[index]), lm.shape[0]
+
     def __len__(self):
-        return len(self.lmList)
\ No newline at end of file
+        return len(self.labels)
+
+
+class PackedLandmarkListTest(PackedLandmarkList):
+    def __getitem__(self, index):
+        lm = self._sequence(index)
+        return lm, int(self.labels[index]), lm.shape[0], str(self.paths[index])
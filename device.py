@@ -0,0 +1,90 @@
+import os
+
+import torch
+
+
+def parse_cpu_list(text):
+    # '0-3,8,10-11' (sysfs cpulist / taskset format) --> [0, 1, 2, 3, 8, 10, 11]
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        lo, _, hi = part.partition('-')
+        cpus.extend(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+
+def numa_cpus(node):
+    # cpus of one NUMA node (Linux sysfs)
+    with open('/sys/devices/system/node/node{}/cpulist'.format(node)) as fp:
+        return parse_cpu_list(fp.read())
+
+
+def numa_nodes():
+    root = '/sys/devices/system/node'
+    if not os.path.isdir(root):
+        return []
+    return sorted(int(d[4:]) for d in os.listdir(root) if d.startswith('node') and d[4:].isdigit())
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _format_cpus(cpus):
+    # inverse of parse_cpu_list
+    ranges = []
+    for c in cpus:
+        if ranges and c == ranges[-1][1] + 1:
+            ranges[-1][1] = c
+        else:
+            ranges.append([c, c])
+    return ','.join(str(lo) if lo == hi else '{}-{}'.format(lo, hi) for lo, hi in ranges)
+
+
+def setup_device(device, threads=0, interop_threads=0, numa_node=None, cpus=None, verbose=True):
+    # Picks the device every script runs on and configures CPU parallelism; returns the torch.device.
+    # device: a GPU index (the old DEVICES constant), 'cuda:N', 'cuda' or 'cpu'. A GPU that is not
+    # there falls back to the CPU.
+    # CPU side (also the data loading / collation threads of GPU runs):
+    # - numa_node / cpus ('0-15,32-47') pin the process to those cores before torch starts its
+    #   thread pools, so the intra-op threads and their memory stay on one socket
+    # - threads: intra-op threads (torch.set_num_threads), 0 = torch's default, capped at the number
+    #   of CPUs we are pinned to
+    # - interop_threads: inter-op threads, 0 = torch default; only settable before the first
+    #   parallel op, so call this at the top of a script
+    if isinstance(device, int):
+        device = torch.device('cuda', device)
+    device = torch.device(device)
+    note = ''
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        device, note = torch.device('cpu'), ' (no CUDA device, {} requested)'.format(device)
+
+    if numa_node is not None:
+        cpus = numa_cpus(numa_node)
+    elif isinstance(cpus, str):
+        cpus = parse_cpu_list(cpus)
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    n_cpus = len(available_cpus())
+    if threads:
+        torch.set_num_threads(threads)
+    elif cpus and torch.get_num_threads() > n_cpus:
+        torch.set_num_threads(n_cpus)
+    if interop_threads and torch.get_num_interop_threads() != interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            note += ' (inter-op threads not set: {})'.format(e)
+
+    if device.type == 'cuda':
+        if device.index is not None:
+            torch.cuda.set_device(device)
+        note = ',gpu,{}'.format(torch.cuda.get_device_name(device)) + note
+    if verbose:
+        print('device,{},intra_op_threads,{},inter_op_threads,{},cpus,{},affinity,{},numa_nodes,{}{}'.format(
+            device, torch.get_num_threads(), torch.get_num_interop_threads(), n_cpus, _format_cpus(available_cpus()),
+            len(numa_nodes()) or 1, note))
+    return device
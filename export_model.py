@@ -0,0 +1,148 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+
+from model import MODELS, FRAMEWISE, build_model, framewise_scores, length_mask, output_lengths
+
+
+EMBEDDING_DIM = int(68 * 67 /2)
+HIDDEN_DIM = 128
+
+
+def example_inputs(batch_size, frames, embedding_dim):
+    # zero-padded batch with lengths spread over [frames / 2, frames] (the first one full length)
+    lengths = torch.linspace(frames, max(frames // 2, 1), batch_size).long()
+    landmarks = torch.randn(batch_size, frames, embedding_dim)
+    return landmarks.masked_fill(~length_mask(lengths, frames).unsqueeze(2), 0.), lengths
+
+
+def export_script(model, path=None):
+    scripted = torch.jit.script(model)
+    if path is not None:
+        scripted.save(path)
+    return scripted
+
+
+def export_program(model, frames, embedding_dim, path=None):
+    # The batch axis is always dynamic. nn.GRU / nn.LSTM and MaxPool1d specialize the frame axis, so
+    # those programs take exactly `frames` padded frames; only models that allow it (cnn) keep it dynamic.
+    # --> (ExportedProgram, dynamic frame axis)
+    example = example_inputs(2, frames, embedding_dim)
+    batch = torch.export.Dim('batch', min=1, max=4096)
+    try:
+        time_axis = torch.export.Dim('frames', min=8, max=65536)
+        program = torch.export.export(model, example, dynamic_shapes=({0: batch, 1: time_axis}, {0: batch}))
+        dynamic = True
+    except torch._dynamo.exc.UserError:
+        program = torch.export.export(model, example, dynamic_shapes=({0: batch}, {0: batch}))
+        dynamic = False
+    if path is not None:
+        torch.export.save(program, path)
+    return program, dynamic
+
+
+def load_exported(path):
+    # TorchScript (.pt) or torch.export (.pt2) file --> callable model(landmarks, lengths)
+    if path.endswith('.pt2'):
+        return torch.export.load(path).module()
+    return torch.jit.load(path, map_location='cpu')
+
+
+def max_difference(rnn, model, exported, frames, embedding_dim, batch_size=8):
+    landmarks, lengths = example_inputs(batch_size, frames, embedding_dim)
+    with torch.no_grad():
+        ref, out = model(landmarks, lengths), exported(landmarks, lengths)
+    if rnn in FRAMEWISE:
+        # per-frame logits are undefined past each length, compare the sequence scores
+        pooled = output_lengths(model, lengths)
+        ref, out = framewise_scores(ref, pooled), framewise_scores(out, pooled)
+    return (ref - out).abs().max().item()
+
+
+def latency(model, landmarks, lengths, repeat=20, warmup=3):
+    # median milliseconds per forward
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeat):
+            start = time.perf_counter()
+            model(landmarks, lengths)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1000.
+
+
+def get_model(args):
+    model = build_model(args.rnn, args.embedding_dim, args.hidden_dim, 1, n_layer=args.layers)
+    if args.checkpoint is not None:
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    return model.eval()
+
+
+def export(args):
+    model = get_model(args)
+    if args.out.endswith('.pt2'):
+        exported, dynamic = export_program(model, args.frames, args.embedding_dim, args.out)
+        exported = exported.module()
+        print('torch.export program, dynamic batch, {} frames'.format('dynamic' if dynamic else args.frames))
+    else:
+        exported = export_script(model, args.out)
+        print('TorchScript module')
+    print('saved {} to {}, max difference to eager {:.2e}'.format(
+        args.rnn, args.out, max_difference(args.rnn, model, exported, args.frames, args.embedding_dim)))
+
+
+def bench(args):
+    # CPU latency of eager vs. TorchScript vs. torch.export at every batch size x frame count
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = get_model(args)
+    scripted = export_script(model)
+    program, dynamic = None, False
+    print('batch,frames,eager_ms,script_ms,export_ms,script_speedup,export_speedup')
+    for frames in args.frames:
+        # a static frame axis needs one program per frame count
+        if not dynamic:
+            program, dynamic = export_program(model, frames, args.embedding_dim)
+        exported = program.module()
+        for batch_size in args.batch_sizes:
+            landmarks, lengths = example_inputs(batch_size, frames, args.embedding_dim)
+            ms = [latency(m, landmarks, lengths, args.repeat) for m in (model, scripted, exported)]
+            print('{},{},{:.2f},{:.2f},{:.2f},{:.2f}x,{:.2f}x'.format(
+                batch_size, frames, ms[0], ms[1], ms[2], ms[0] / ms[1], ms[0] / ms[2]))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='TorchScript / torch.export deployment of the classifiers')
+    sub = parser.add_subparsers(dest='command')
+    for name, description in (
+            ('export', 'write a TorchScript (.pt) or torch.export (.pt2) file and check it against eager'),
+            ('bench', 'CPU latency of eager, TorchScript and torch.export')):
+        p = sub.add_parser(name, help=description)
+        p.add_argument('rnn', choices=list(MODELS))
+        p.add_argument('--checkpoint', default=None, help='state_dict saved by train.py (default: random weights)')
+        p.add_argument('--embedding-dim', type=int, default=EMBEDDING_DIM)
+        p.add_argument('--hidden-dim', type=int, default=HIDDEN_DIM)
+        p.add_argument('--layers', type=int, default=1)
+    p = sub.choices['export']
+    p.add_argument('out', help='*.pt: TorchScript, *.pt2: torch.export')
+    p.add_argument('--frames', type=int, default=300, help='padded frames per sequence when the frame axis is static')
+    p = sub.choices['bench']
+    p.add_argument('--batch-sizes', type=lambda s: [int(x) for x in s.split(',')], default=[1, 8, 64])
+    p.add_argument('--frames', type=lambda s: [int(x) for x in s.split(',')], default=[100, 300])
+    p.add_argument('--repeat', type=int, default=20)
+    p.add_argument('--threads', type=int, default=0, help='torch.set_num_threads (0: torch default)')
+    args = parser.parse_args(argv[1:])
+
+    if args.command == 'export':
+        export(args)
+    elif args.command == 'bench':
+        bench(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,41 @@
+import torch
+from torch.nn.utils.rnn import PackedSequence
+
+
+N_POINTS = 68
+
+_triu_cache = {}
+
+
+def _triu_indices(n_points, device):
+    key = (n_points, str(device))
+    if key not in _triu_cache:
+        _triu_cache[key] = torch.triu_indices(n_points, n_points, offset=1, device=device)
+    return _triu_cache[key]
+
+
+def pairwise_distance(landmarks, n_points=N_POINTS):
+    # (..., n_points*2) raw coordinates stored as x0, y0, x1, y1, ... -->
+    # (..., n_points*(n_points-1)/2) distances of the upper triangle, row-major (0-1, 0-2, ..., 66-67)
+    # all-zero (padded) frames map to all-zero distances, so padding stays padding
+    lead = landmarks.shape[:-1]
+    points = landmarks.reshape(-1, n_points, 2)
+    i, j = _triu_indices(n_points, landmarks.device)
+    dist = (points[:, i] - points[:, j]).norm(dim=-1)
+    return dist.view(*lead, -1)
+
+
+class PairwiseDistanceCollate(object):
+    # Wraps a padded or packed collate_fn so only the 136-d Data_Landmark files are read and the
+    # 2278-d distance features are computed once per collated (B, T, 136) batch.
+    def __init__(self, collate_fn, n_points=N_POINTS):
+        self.collate_fn = collate_fn
+        self.n_points = n_points
+
+    def __call__(self, batch):
+        out = self.collate_fn(batch)
+        if isinstance(out[0], PackedSequence):
+            lms = out[0]._replace(data=pairwise_distance(out[0].data, self.n_points))
+        else:
+            lms = pairwise_distance(out[0], self.n_points)
+        return (lms,) + tuple(out[1:])
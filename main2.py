@@ -4,6 +4,8 @@ import torch.nn.functional as F
 import torch.optim as optim
 from dataset2 import LandmarkList
 from torch.utils import data
+from collate import pad_collate
+from device import setup_device
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import argparse
 
@@ -17,19 +19,10 @@ EMBEDDING_DIM = 68*2
 HIDDEN_DIM = 68*4
 MAX_EPOCH = 10
 DEVICES = 2
-torch.cuda.set_device(DEVICES)
-
-
-def pad_collate(batch):
-    batch.sort(key=lambda x: x[2], reverse=True)
-    lms, tgs, lens = zip(*batch)
-    new_lms = torch.zeros((len(lms), lms[0].shape[0], lms[0].shape[1])) # batch x seq x feature(136)
-    new_lms[0] = lms[0]
-    for i in range(1, len(lms)):
-        # import pdb;
-        # pdb.set_trace()
-        new_lms[i] = torch.cat((lms[i], torch.zeros((lens[0] - lens[i]),136)), 0)
-    return new_lms, tgs, lens
+THREADS = 0
+INTEROP_THREADS = 0
+NUMA_NODE = None
+device = setup_device(DEVICES, THREADS, INTEROP_THREADS, NUMA_NODE)
 
 
 class LSTM_Classifier(nn.Module):
@@ -101,7 +94,7 @@ tensor([[[-0.0176,  0.1605,  0.1339,  ..., -0.0914,  0.2951, -0.0065],
 
 
 model = LSTM_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1)
-model = model.cuda()
+model = model.to(device)
 loss_function = torch.nn.BCEWithLogitsLoss()
 optimizer = optim.Adam(model.parameters(), lr=1e-4)
 # l2 = torch.nn.BCELoss()
@@ -126,10 +119,10 @@ dataloader_train = data.DataLoader(dataset_train, batch_size=128, shuffle=True,
 for i in range(MAX_EPOCH):
     for batch, labels, lengths in dataloader_train:
         model.zero_grad()
-        out = model(batch.cuda(), lengths) # we could do a classifcation for every output (probably better)
+        out = model(batch.to(device), lengths) # we could do a classifcation for every output (probably better)
         # import pdb;
         # pdb.set_trace()
-        loss = loss_function(out, torch.FloatTensor(labels).unsqueeze(1).cuda())
+        loss = loss_function(out, torch.FloatTensor(labels).unsqueeze(1).to(device))
         # loss = l2(nn.Sigmoid()(out), labels)
         print(loss.data)
         loss.backward()
@@ -4,6 +4,9 @@ import torch.nn.functional as F
 import torch.optim as optim
 from dataset import LandmarkList
 from torch.utils import data
+from collate import pad_collate
+from device import setup_device
+from prefetch import Prefetcher
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import argparse
 
@@ -19,7 +22,10 @@ DROPOUT = 0.5
 MAX_EPOCH = 1000
 LR = 1e-4
 DEVICES = 1
-torch.cuda.set_device(DEVICES)
+THREADS = 0
+INTEROP_THREADS = 0
+NUMA_NODE = None
+device = setup_device(DEVICES, THREADS, INTEROP_THREADS, NUMA_NODE)
 SAVE_BEST_MODEL = True
 
 
@@ -30,23 +36,13 @@ def compute_binary_accuracy(model, data_loader, loss_function):
         for batch, labels, lengths in data_loader:
             # import pdb;
             # pdb.set_trace()
-            logits = model(batch.cuda(), lengths)
-            total_loss += loss_function(logits, torch.LongTensor(labels).cuda()).item()
+            logits = model(batch, lengths)
+            total_loss += loss_function(logits, labels).item()
             # predicted_labels = (torch.sigmoid(logits) > 0.5).long()
             _, predicted_labels = torch.max(logits, 1)
             num_examples += len(lengths)
-            correct_pred += (predicted_labels.cpu().long() == torch.LongTensor(labels)).sum()
-        return correct_pred.float().item()/num_examples * 100, total_loss
-
-
-def pad_collate(batch):
-    batch.sort(key=lambda x: x[2], reverse=True)
-    lms, tgs, lens = zip(*batch)
-    new_lms = torch.zeros((len(lms), lms[0].shape[0], lms[0].shape[1])) # batch x seq x feature(136)
-    new_lms[0] = lms[0]
-    for i in range(1, len(lms)):
-        new_lms[i] = torch.cat((lms[i], torch.zeros((lens[0] - lens[i]),136)), 0)
-    return new_lms, tgs, lens
+            correct_pred += (predicted_labels == labels).sum().item()
+        return correct_pred/num_examples * 100, total_loss
 
 
 class LSTM_Classifier(nn.Module):
@@ -156,7 +152,7 @@ if rnn == 'biGRU':
     model = biGRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 2)
 if rnn == 'LSTM':
     model = LSTM_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 2)
-model = model.cuda()
+model = model.to(device)
 loss_function = torch.nn.CrossEntropyLoss()
 loss_function_eval_sum = torch.nn.CrossEntropyLoss(reduction='sum')
 optimizer = optim.Adam(model.parameters(), lr=LR)
@@ -169,21 +165,24 @@ dataloader_train = data.DataLoader(dataset_train, batch_size=128, shuffle=True,
 dataset_test = LandmarkList(root='/datasets/move_closer/Data_Landmark/', fileList='/datasets/move_closer/TestList.txt')
 dataloader_test = data.DataLoader(dataset_test, batch_size=64, shuffle=False, num_workers=1, collate_fn=pad_collate)
 
+prefetch_train = Prefetcher(dataloader_train, device)
+prefetch_test = Prefetcher(dataloader_test, device)
+
 best_test_acc = 0.
 for epoch in range(MAX_EPOCH):
     model.train()
     n_iter = 0
-    for batch, labels, lengths in dataloader_train:
+    for batch, labels, lengths in prefetch_train:
         model.zero_grad()
-        out = model(batch.cuda(), lengths)  # we could do a classifcation for every output (probably better)
+        out = model(batch, lengths)  # we could do a classifcation for every output (probably better)
         # import pdb; pdb.set_trace()
-        loss = loss_function(out, torch.LongTensor(labels).cuda())
+        loss = loss_function(out, labels)
         # loss = l2(nn.Sigmoid()(out), labels)
         loss.backward()
         optimizer.step()
         n_iter += 1
-    train_acc, train_loss = compute_binary_accuracy(model, dataloader_train, loss_function_eval_sum)
-    test_acc, test_loss = compute_binary_accuracy(model, dataloader_test, loss_function_eval_sum)
+    train_acc, train_loss = compute_binary_accuracy(model, prefetch_train, loss_function_eval_sum)
+    test_acc, test_loss = compute_binary_accuracy(model, prefetch_test, loss_function_eval_sum)
     print('Epoch{},train_acc,{:.2f}%,train_loss,{:.8f},valid_acc,{:.2f}%,valid_loss,{:.8f}'.format(epoch, train_acc, train_loss, test_acc, test_loss))
     if test_acc > best_test_acc:
         best_test_acc = test_acc
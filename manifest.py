@@ -0,0 +1,112 @@
+import argparse
+import functools
+import hashlib
+import os
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+
+from dataset import default_list_reader, default_loader
+
+
+def _file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def scan_file(path, loader=default_loader, with_hash=False):
+    lm = loader(path)
+    dim = lm.shape[1] if len(lm.shape) > 1 else 1
+    return lm.shape[0], dim, _file_hash(path) if with_hash else ''
+
+
+def load_manifest(path):
+    with np.load(path) as index:
+        return {k: index[k] for k in index.files}
+
+
+def build_manifest(root, fileList, out, processes=None, with_hash=False,
+                   list_reader=default_list_reader, loader=default_loader):
+    # One row per list entry: path, label, num_frames, dim, size, mtime_ns[, sha1].
+    # Rows of an existing manifest at `out` are reused when path, size and mtime still match,
+    # so only new or changed files are unpickled (in a process pool).
+    lmList = list_reader(fileList)
+    n = len(lmList)
+    paths = np.array([p for p, _ in lmList])
+    labels = np.array([t for _, t in lmList], dtype=np.int64)
+    size = np.zeros(n, dtype=np.int64)
+    mtime = np.zeros(n, dtype=np.int64)
+    for i, lmPath in enumerate(paths):
+        st = os.stat(os.path.join(root, lmPath))
+        size[i], mtime[i] = st.st_size, st.st_mtime_ns
+    num_frames = np.zeros(n, dtype=np.int64)
+    dim = np.zeros(n, dtype=np.int64)
+    sha1 = np.zeros(n, dtype='S40')
+
+    todo = np.ones(n, dtype=bool)
+    if os.path.exists(out):
+        old = load_manifest(out)
+        old_rows = dict((p, i) for i, p in enumerate(old['paths'].tolist()))
+        for i, lmPath in enumerate(paths.tolist()):
+            j = old_rows.get(lmPath)
+            if j is None or old['size'][j] != size[i] or old['mtime'][j] != mtime[i]:
+                continue
+            if with_hash and not old['sha1'][j]:
+                continue
+            num_frames[i], dim[i], sha1[i] = old['num_frames'][j], old['dim'][j], old['sha1'][j]
+            todo[i] = False
+
+    rescan = np.nonzero(todo)[0]
+    if len(rescan):
+        scan = functools.partial(scan_file, loader=loader, with_hash=with_hash)
+        files = [os.path.join(root, paths[i]) for i in rescan]
+        pool = Pool(processes)
+        try:
+            for i, (frames, d, digest) in zip(rescan, pool.imap(scan, files, chunksize=64)):
+                num_frames[i], dim[i], sha1[i] = frames, d, digest
+        finally:
+            pool.close()
+            pool.join()
+
+    # written next to the target and renamed, so readers never see a half-written manifest
+    with open(out + '.tmp', 'wb') as fp:
+        np.savez(fp, paths=paths, labels=labels, num_frames=num_frames, dim=dim, size=size, mtime=mtime, sha1=sha1)
+    os.replace(out + '.tmp', out)
+    return len(rescan), n
+
+
+def manifest_is_stale(root, fileList, path):
+    # missing, older than the list, or a data file whose size / mtime no longer matches its row
+    # (one stat per file, no unpickling)
+    if not os.path.exists(path) or os.path.getmtime(fileList) > os.path.getmtime(path):
+        return True
+    index = load_manifest(path)
+    for lmPath, size, mtime in zip(index['paths'].tolist(), index['size'].tolist(), index['mtime'].tolist()):
+        try:
+            st = os.stat(os.path.join(root, lmPath))
+        except OSError:
+            return True
+        if st.st_size != size or st.st_mtime_ns != mtime:
+            return True
+    return False
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Build or refresh the manifest of a landmark file list')
+    parser.add_argument('root', help='data root, e.g. /datasets/move_closer/Data_Distortion/')
+    parser.add_argument('file_list', help='list file, e.g. /datasets/move_closer/TrainList.txt')
+    parser.add_argument('out', help='manifest file (.npz)')
+    parser.add_argument('--processes', type=int, default=None, help='scan processes, default all cores')
+    parser.add_argument('--hash', action='store_true', help='also store the sha1 of every file')
+    args = parser.parse_args(argv[1:])
+
+    n_scanned, n = build_manifest(args.root, args.file_list, args.out, args.processes, args.hash)
+    print('scanned {} of {} files, manifest written to {}'.format(n_scanned, n, args.out))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
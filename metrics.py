@@ -0,0 +1,73 @@
+import numpy as np
+import torch
+
+from model import framewise_scores, output_lengths
+
+
+def sequence_scores(model, batch, lengths, framewise=False):
+    # sigmoid score per sequence; framewise models are scored by the mean over their valid frames
+    logits = model(batch, lengths)
+    if framewise:
+        return framewise_scores(logits, output_lengths(model, lengths))
+    return torch.sigmoid(logits).squeeze(1)
+
+
+def collect_scores(model, data_loader, device, framewise=False):
+    # One forward per batch; scores, labels and names come back in loader order.
+    scores, labels_all, names = [], [], []
+    model.eval()
+    with torch.no_grad():
+        for batch, labels, lengths, f_names in data_loader:
+            scores.append(sequence_scores(model, batch.to(device), lengths, framewise).float().cpu())
+            labels_all.extend(int(x) for x in labels)
+            names.extend(f_names)
+    return torch.cat(scores), torch.LongTensor(labels_all), names
+
+
+def threshold_sweep(scores, labels, th_list):
+    # Accuracy / FP / FN for every threshold (predicted positive iff score > th) from two sorted
+    # arrays and a searchsorted, instead of one comparison per sample and threshold.
+    th = torch.tensor(th_list, dtype=scores.dtype)
+    pos = torch.sort(scores[labels == 1])[0]
+    neg = torch.sort(scores[labels == 0])[0]
+    FN = torch.searchsorted(pos, th, right=True)
+    FP = len(neg) - torch.searchsorted(neg, th, right=True)
+    correct = len(scores) - FN - FP
+    return correct.double() / max(len(scores), 1) * 100, FP, FN
+
+
+def error_lists(scores, labels, names, FP, FN):
+    # '<name>_<label>_<score>' of every FP / FN per threshold, in loader order
+    entries = ['{}_{}_{}'.format(n, l, s) for n, l, s in zip(names, labels.tolist(), scores.tolist())]
+    neg = torch.nonzero(labels == 0).squeeze(1)
+    pos = torch.nonzero(labels == 1).squeeze(1)
+    # highest-scored negatives are the first to become FPs, lowest-scored positives the first FNs
+    neg = neg[torch.argsort(scores[neg], descending=True, stable=True)].numpy()
+    pos = pos[torch.argsort(scores[pos], stable=True)].numpy()
+    FP_list = [[entries[i] for i in np.sort(neg[:int(n)])] for n in FP]
+    FN_list = [[entries[i] for i in np.sort(pos[:int(n)])] for n in FN]
+    return FP_list, FN_list
+
+
+def roc_curve(scores, labels):
+    # every distinct score as threshold, high to low: (threshold, fpr, tpr); DET uses (fpr, 1 - tpr)
+    order = torch.argsort(scores, descending=True)
+    s, y = scores[order], labels[order]
+    last = torch.ones(len(s), dtype=torch.bool)
+    last[:-1] = s[1:] != s[:-1]
+    tp = torch.cumsum(y, 0)[last].double()
+    fp = torch.cumsum(1 - y, 0)[last].double()
+    return s[last], fp / max(int((labels == 0).sum()), 1), tp / max(int((labels == 1).sum()), 1)
+
+
+def equal_error_rate(fpr, tpr):
+    fnr = 1 - tpr
+    i = int(torch.argmin((fpr - fnr).abs()))
+    return float((fpr[i] + fnr[i]) / 2) * 100
+
+
+def write_curve(path, thresholds, fpr, tpr):
+    with open(path, 'w') as fp:
+        fp.write('threshold,fpr,tpr,fnr\n')
+        for t, f, p in zip(thresholds.tolist(), fpr.tolist(), tpr.tolist()):
+            fp.write('{},{},{},{}\n'.format(t, f, p, 1 - p))
@@ -1,13 +1,202 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, PackedSequence
 
 
 DROPOUT = 0.5
 
 
-class LSTM_Classifier(nn.Module):
+def pack_input(landmarks, lengths):
+    # collate.PadCollate(packed=True) already hands over a PackedSequence; padded batches
+    # no longer need to be sorted by length
+    if isinstance(landmarks, PackedSequence):
+        return landmarks
+    return pack_padded_sequence(landmarks, lengths, batch_first=True, enforce_sorted=False)
+
+
+def pooled_lengths(lengths, scale_pool):
+    # type: (Tensor, int) -> Tensor
+    # valid frames after pooling the time axis by scale_pool; a sequence shorter than one pool keeps
+    # its first pooled frame, so masked means and packing never see a length of 0
+    return torch.clamp(lengths // scale_pool, min=1)
+
+
+def output_lengths(model, lengths):
+    # frames per sequence in the model output (conv front-ends pool the time axis by scale_pool)
+    lengths = torch.as_tensor(lengths)
+    return pooled_lengths(lengths, getattr(model, 'scale_pool', 1))
+
+
+def length_mask(lengths, max_len, device=None):
+    # type: (Tensor, int, Optional[torch.device]) -> Tensor
+    # (b, max_len) bool, True on the valid frames of each sequence
+    lengths = torch.as_tensor(lengths, device=device)
+    return torch.arange(max_len, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+
+
+def framewise_loss(logits, labels, lengths, reduction='mean'):
+    # BCE of every valid frame of (b, seq, 1) logits against its sequence label;
+    # 'mean' averages over frames like BCEWithLogitsLoss on the concatenated frames
+    mask = length_mask(lengths, logits.shape[1], logits.device)
+    target = torch.as_tensor(labels, dtype=torch.float, device=logits.device).unsqueeze(1).expand_as(mask)
+    loss = F.binary_cross_entropy_with_logits(logits.squeeze(2), target, reduction='none')
+    loss = loss.masked_fill(~mask, 0.).sum()
+    if reduction == 'mean':
+        loss = loss / mask.sum()
+    return loss
+
+
+def masked_mean(x, lengths):
+    # (b, seq, c) --> (b, c): mean over the first lengths[i] frames of each sequence
+    lengths = torch.as_tensor(lengths, device=x.device).clamp(min=1)
+    mask = length_mask(lengths, x.shape[1])
+    return x.masked_fill(~mask.unsqueeze(2), 0.).sum(1) / lengths.unsqueeze(1).to(x.dtype)
+
+
+def framewise_scores(logits, lengths):
+    # (b,) score of a framewise model: mean sigmoid over the valid frames
+    return masked_mean(torch.sigmoid(logits), lengths).squeeze(1)
+
+
+def batch_loss(model, out, labels, lengths, framewise, reduction='mean'):
+    # --> loss, (b,) scores, number of outputs the loss averages over (valid frames or sequences);
+    # framewise models classify every valid (pooled) frame against its sequence label
+    if framewise:
+        frame_lengths = output_lengths(model, lengths)
+        loss = framewise_loss(out, labels, frame_lengths, reduction)
+        return loss, framewise_scores(out.detach(), frame_lengths), frame_lengths.sum()
+    target = torch.as_tensor(labels, dtype=torch.float, device=out.device).unsqueeze(1)
+    loss = F.binary_cross_entropy_with_logits(out, target, reduction=reduction)
+    return loss, torch.sigmoid(out.detach()).squeeze(1), out.shape[0]
+
+
+def count_correct(scores, labels):
+    # sequences whose score falls on the side of 0.5 given by their label
+    return ((scores > 0.5).long() == torch.as_tensor(labels, device=scores.device)).sum()
+
+
+def recurrent_step(rnn, frames, state, lengths=None):
+    # Streaming update of an nn.GRU / nn.LSTM for a batch of live sequences: frames is (b, dim) or
+    # (b, t, dim) new frames, state the hidden state after everything seen so far (batch on dim 1,
+    # None for fresh sequences). With lengths, sequence i only has lengths[i] of the t new frames.
+    if rnn.bidirectional:
+        raise ValueError('bidirectional recurrent layers cannot be run incrementally')
+    if frames.dim() == 2:
+        frames = frames.unsqueeze(1)
+    if lengths is None:
+        _, state = rnn(frames.transpose(0, 1), state)
+    else:
+        _, state = rnn(pack_input(frames, lengths), state)
+    return state
+
+
+@torch.jit.unused
+def exporting():
+    # type: () -> bool
+    return torch.compiler.is_exporting()
+
+
+def last_frame(output, lengths):
+    # (b, seq, c) --> (b, c): the frame lengths[i] - 1 of each sequence
+    index = (lengths - 1).clamp(min=0).view(-1, 1, 1).expand(-1, 1, output.shape[2])
+    return output.gather(1, index).squeeze(1)
+
+
+def reverse_frames(x, lengths):
+    # (b, seq, c) with the first lengths[i] frames of each sequence in reverse order, padding in place
+    t = torch.arange(x.shape[1], device=x.device).unsqueeze(0)
+    n = lengths.unsqueeze(1)
+    index = torch.where(t < n, n - 1 - t, t)
+    return x.gather(1, index.unsqueeze(2).expand(-1, -1, x.shape[2]))
+
+
+def _gru_direction(x, w_ih, w_hh, b_ih, b_hh):
+    # one GRU layer / direction over (b, seq, dim) from a zero state, gates in nn.GRU order (r, z, n)
+    hidden = w_hh.shape[1]
+    gates_x = F.linear(x, w_ih, b_ih)
+    h = x.new_zeros((x.shape[0], hidden))
+    output = []
+    for t in range(x.shape[1]):
+        gx, gh = gates_x[:, t], F.linear(h, w_hh, b_hh)
+        r = torch.sigmoid(gx[:, :hidden] + gh[:, :hidden])
+        z = torch.sigmoid(gx[:, hidden:2 * hidden] + gh[:, hidden:2 * hidden])
+        n = torch.tanh(gx[:, 2 * hidden:] + r * gh[:, 2 * hidden:])
+        h = (1 - z) * n + z * h
+        output.append(h)
+    return torch.stack(output, 1)
+
+
+def bidirectional_gru(gru, x, lengths):
+    # A bidirectional nn.GRU over a zero-padded (b, seq, dim) batch without packing, which torch.export
+    # cannot trace: the reverse direction runs over each sequence reversed within its length, so no
+    # padding frame reaches a valid one. --> top-layer output (b, seq, 2 * hidden), final states (2, b, hidden)
+    weights = gru._flat_weights
+    for layer in range(gru.num_layers):
+        if layer > 0:
+            x = F.dropout(x, gru.dropout, gru.training)
+        forward = _gru_direction(x, *weights[8 * layer:8 * layer + 4])
+        backward = _gru_direction(reverse_frames(x, lengths), *weights[8 * layer + 4:8 * layer + 8])
+        x = torch.cat((forward, reverse_frames(backward, lengths)), 2)
+    return x, torch.stack((last_frame(forward, lengths), last_frame(backward, lengths)))
+
+
+class SequenceModel(nn.Module):
+    # Pieces shared by the classifiers below. Every model also runs under torch.jit.script and
+    # torch.export when lengths is a tensor (see export_model.py).
+    # loss scale of the gradients clip_grad sees (set by precision.backward)
+    grad_scale = 1.
+
+    def run_gru(self, landmarks, lengths, with_output=False):
+        # type: (Tensor, Tensor, bool) -> Tuple[Tensor, Tensor]
+        # self.gru over a PackedSequence or a padded (b, seq, dim) batch --> top-layer output
+        # (b, seq, directions * hidden), zero past each length (empty unless with_output), and the
+        # top-layer final state per direction (directions, b, hidden)
+        if not torch.jit.is_scripting() and exporting():
+            return self._run_gru_padded(landmarks, lengths)
+        packed_output, ht = self.gru(pack_input(landmarks, lengths))
+        output = torch.empty(0)
+        if with_output:
+            output, _ = pad_packed_sequence(packed_output, batch_first=True)
+        return output, ht[ht.shape[0] - (2 if self.gru.bidirectional else 1):]
+
+    @torch.jit.unused
+    def _run_gru_padded(self, landmarks, lengths):
+        # type: (Tensor, Tensor) -> Tuple[Tensor, Tensor]
+        # torch.export cannot trace packing: run on the padded batch and gather each last valid frame
+        lengths = lengths.to(landmarks.device)
+        if self.gru.bidirectional:
+            output, ht = bidirectional_gru(self.gru, landmarks, lengths)
+        else:
+            output, _ = self.gru(landmarks.transpose(0, 1))
+            output = output.transpose(0, 1)
+            ht = last_frame(output, lengths).unsqueeze(0)
+        return output.masked_fill(~length_mask(lengths, output.shape[1]).unsqueeze(2), 0.), ht
+
+    @torch.jit.unused
+    def clip_grad(self, ht):
+        if ht.requires_grad and not exporting():
+            ht.register_hook(lambda x: x.clamp(min=-self.grad_clipping * self.grad_scale,
+                                               max=self.grad_clipping * self.grad_scale))
+
+    def check_n_layers(self):
+        if self.n_layers not in (2, 4, 6, 8):
+            raise ValueError('n_layers must be 2, 4, 6 or 8, got {}'.format(self.n_layers))
+
+    def conv_front(self, x):
+        # conv1 .. conv<n_layers> with bn / ReLU and a max-pool after every second conv but the 8th;
+        # hasattr is resolved when scripting, so absent layers compile away
+        x = self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(x)))))))
+        if hasattr(self, 'conv4'):
+            x = self.p2(F.relu(self.bn4(self.conv4(F.relu(self.bn3(self.conv3(x)))))))
+        if hasattr(self, 'conv6'):
+            x = self.p3(F.relu(self.bn6(self.conv6(F.relu(self.bn5(self.conv5(x)))))))
+        if hasattr(self, 'conv8'):
+            x = F.relu(self.bn8(self.conv8(F.relu(self.bn7(self.conv7(x))))))
+        return x
+
+
+class LSTM_Classifier(SequenceModel):
 
     def __init__(self, embedding_dim, hidden_dim, target_size=1, bidirectional=False, n_layer=1):
         super(LSTM_Classifier, self).__init__()
@@ -22,14 +211,33 @@ class LSTM_Classifier(nn.Module):
         self.dropout = nn.Dropout(DROPOUT)
 
     def forward(self, landmarks, lengths):
-        packed_input = pack_padded_sequence(landmarks, lengths, batch_first=True)
-        _, (ht, _) = self.lstm(packed_input)
-        ht = self.dropout(ht[-1])
+        if not torch.jit.is_scripting() and exporting():
+            ht = self._last_state_padded(landmarks, lengths)
+        else:
+            _, (ht, _) = self.lstm(pack_input(landmarks, lengths))
+            ht = ht[-1]
+        ht = self.dropout(ht)
         logit = self.lc(ht)
         return logit
 
+    @torch.jit.unused
+    def _last_state_padded(self, landmarks, lengths):
+        # type: (Tensor, Tensor) -> Tensor
+        # see SequenceModel.run_gru
+        output, _ = self.lstm(landmarks.transpose(0, 1))
+        return last_frame(output.transpose(0, 1), lengths.to(landmarks.device))
+
+    def init_state(self, batch_size, device=None):
+        shape = (self.lstm.num_layers, batch_size, self.hidden_dim)
+        return torch.zeros(shape, device=device), torch.zeros(shape, device=device)
+
+    def step(self, frames, state, lengths=None):
+        # incremental forward: logit of every sequence so far and the new state, see recurrent_step
+        state = recurrent_step(self.lstm, frames, state, lengths)
+        return self.lc(self.dropout(state[0][-1])), state
 
-class embed_GRU_Classifier(nn.Module):
+
+class embed_GRU_Classifier(SequenceModel):
 
     def __init__(self, embedding_dim, hidden_dim, target_size=1, bidirectional=False, n_layer=1):
         super(embed_GRU_Classifier, self).__init__()
@@ -62,16 +270,27 @@ class embed_GRU_Classifier(nn.Module):
 
     def forward(self, landmarks, lengths):
         # import pdb; pdb.set_trace()
-        landmarks = F.tanh(self.embed2(F.tanh(self.embed1(landmarks))))
-        packed_input = pack_padded_sequence(landmarks, lengths, batch_first=True)
-        _, ht = self.gru(packed_input)
+        if isinstance(landmarks, PackedSequence):
+            packed_input = landmarks._replace(data=F.tanh(self.embed2(F.tanh(self.embed1(landmarks.data)))))
+        else:
+            packed_input = F.tanh(self.embed2(F.tanh(self.embed1(landmarks))))
+        _, ht = self.run_gru(packed_input, lengths)
         # import pdb; pdb.set_trace()
         ht = self.dropout(ht[-1])
         logit = self.lc2(F.tanh(self.lc1(ht)))
         return logit
 
+    def init_state(self, batch_size, device=None):
+        return torch.zeros((self.gru.num_layers, batch_size, self.hidden_dim), device=device)
+
+    def step(self, frames, state, lengths=None):
+        # incremental forward: logit of every sequence so far and the new state, see recurrent_step
+        frames = F.tanh(self.embed2(F.tanh(self.embed1(frames))))
+        state = recurrent_step(self.gru, frames, state, lengths)
+        return self.lc2(F.tanh(self.lc1(self.dropout(state[-1])))), state
 
-class GRU_Classifier(nn.Module):
+
+class GRU_Classifier(SequenceModel):
 
     def __init__(self, embedding_dim, hidden_dim, target_size=1, bidirectional=False, n_layer=1):
         super(GRU_Classifier, self).__init__()
@@ -88,18 +307,25 @@ class GRU_Classifier(nn.Module):
         self.dropout = nn.Dropout(DROPOUT)
 
     def forward(self, landmarks, lengths):
-        packed_input = pack_padded_sequence(landmarks, lengths, batch_first=True)
-        _, ht = self.gru(packed_input)
+        _, ht = self.run_gru(landmarks, lengths)
         # import pdb; pdb.set_trace()
-        if ht.requires_grad:
-            ht.register_hook(lambda x: x.clamp(min=-self.grad_clipping, max=self.grad_clipping))
+        if not torch.jit.is_scripting():
+            self.clip_grad(ht)
         ht = self.dropout(ht[-1])
         logit = self.lc1(ht)    # probably a 1x1 conv is need to do linear transform
         # logit = self.lc2(F.relu(self.lc1(ht)))
         return logit
 
+    def init_state(self, batch_size, device=None):
+        return torch.zeros((self.gru.num_layers, batch_size, self.hidden_dim), device=device)
+
+    def step(self, frames, state, lengths=None):
+        # incremental forward: logit of every sequence so far and the new state, see recurrent_step
+        state = recurrent_step(self.gru, frames, state, lengths)
+        return self.lc1(self.dropout(state[-1])), state
+
 
-class biGRU_Classifier(nn.Module):
+class biGRU_Classifier(SequenceModel):
 
     def __init__(self, embedding_dim, hidden_dim, target_size=1, bidirectional=True, n_layer=1):
         super(biGRU_Classifier, self).__init__()
@@ -115,16 +341,15 @@ class biGRU_Classifier(nn.Module):
         self.dropout = nn.Dropout(DROPOUT)
 
     def forward(self, landmarks, lengths):
-        packed_input = pack_padded_sequence(landmarks, lengths, batch_first=True)
-        _, ht = self.gru(packed_input)
-        if ht.requires_grad:
-            ht.register_hook(lambda x: x.clamp(min=-self.grad_clipping, max=self.grad_clipping))
+        _, ht = self.run_gru(landmarks, lengths)
+        if not torch.jit.is_scripting():
+            self.clip_grad(ht)
         ht = self.dropout(torch.cat((ht[-2,:,:], ht[-1,:,:]), dim=1))
         logit = self.lc2(F.relu(self.lc1(ht)))
         return logit
 
 
-class Framewise_GRU_Classifier(nn.Module):
+class Framewise_GRU_Classifier(SequenceModel):
 
     def __init__(self, embedding_dim, hidden_dim, target_size=1, bidirectional=False, n_layer=1):
         super(Framewise_GRU_Classifier, self).__init__()
@@ -138,18 +363,17 @@ class Framewise_GRU_Classifier(nn.Module):
         self.dropout = nn.Dropout(DROPOUT)
 
     def forward(self, landmarks, lengths):
-        packed_input = pack_padded_sequence(landmarks, lengths, batch_first=True)
-        packed_output, _ = self.gru(packed_input)
-        output, _ = pad_packed_sequence(packed_output, batch_first=True)
+        output, _ = self.run_gru(landmarks, lengths, True)
+        batch_size = output.shape[0]
         output = output.contiguous()
         output = output.view(-1, self.hidden_dim)
         output = self.dropout(output)
         logit = self.lc1(output)    # probably a 1x1 conv is need to do linear transform
         logit = self.lc2(self.dropout(F.relu(logit)))
-        return logit.view(len(lengths), -1, 1)
+        return logit.view(batch_size, -1, 1)
 
 
-class sumGRU(nn.Module):
+class sumGRU(SequenceModel):
 
     def __init__(self, embedding_dim, hidden_dim, target_size=1, bidirectional=False, n_layer=1):
         super(sumGRU, self).__init__()
@@ -162,9 +386,7 @@ class sumGRU(nn.Module):
         self.dropout = nn.Dropout(DROPOUT)
 
     def forward(self, landmarks, lengths):
-        packed_input = pack_padded_sequence(landmarks, lengths, batch_first=True)
-        packed_output, _ = self.gru(packed_input)
-        output, _ = pad_packed_sequence(packed_output, batch_first=True)
+        output, _ = self.run_gru(landmarks, lengths, True)
         # import pdb; pdb.set_trace()
         output = self.dropout(output.sum(1))
         # logit = self.lc1(output)    # probably a 1x1 conv is need to do linear transform
@@ -173,38 +395,40 @@ class sumGRU(nn.Module):
 
 
 
-class cnn_2d(nn.Module):
+class cnn_2d(SequenceModel):
 
     def __init__(self, embedding_dim, hidden_dim, target_size=1, bidirectional=False):
         super(cnn_2d, self).__init__()
         self.hidden_dim = hidden_dim
         self.n_layers = 2  # 2, 4, 6 ,8
+        self.check_n_layers()
         if self.n_layers >= 2:
             self.conv1 = nn.Conv1d(in_channels=embedding_dim, out_channels=hidden_dim, kernel_size=3, padding=1)
             self.conv2 = nn.Conv1d(in_channels=hidden_dim, out_channels=hidden_dim, kernel_size=3, padding=1)
             self.bn1 = nn.BatchNorm1d(num_features=self.hidden_dim)
             self.bn2 = nn.BatchNorm1d(num_features=self.hidden_dim)
             self.p1 = nn.MaxPool1d(kernel_size=2)
+            self.scale_pool = 2
         if self.n_layers >= 4:
             self.conv3 = nn.Conv1d(in_channels=hidden_dim, out_channels=hidden_dim, kernel_size=3, padding=1)
             self.conv4 = nn.Conv1d(in_channels=hidden_dim, out_channels=hidden_dim, kernel_size=3, padding=1)
             self.bn3 = nn.BatchNorm1d(num_features=self.hidden_dim)
             self.bn4 = nn.BatchNorm1d(num_features=self.hidden_dim)
             self.p2 = nn.MaxPool1d(kernel_size=2)
+            self.scale_pool = 4
         if self.n_layers >= 6:
             self.conv5 = nn.Conv1d(in_channels=hidden_dim, out_channels=hidden_dim, kernel_size=3, padding=1)
             self.conv6 = nn.Conv1d(in_channels=hidden_dim, out_channels=hidden_dim, kernel_size=3, padding=1)
             self.bn5 = nn.BatchNorm1d(num_features=self.hidden_dim)
             self.bn6 = nn.BatchNorm1d(num_features=self.hidden_dim)
             self.p3 = nn.MaxPool1d(kernel_size=2)
+            self.scale_pool = 8
         if self.n_layers == 8:
             self.conv7 = nn.Conv1d(in_channels=hidden_dim, out_channels=hidden_dim, kernel_size=3, padding=1)
             self.conv8 = nn.Conv1d(in_channels=hidden_dim, out_channels=hidden_dim, kernel_size=3, padding=1)
             self.bn7 = nn.BatchNorm1d(num_features=self.hidden_dim)
             self.bn8 = nn.BatchNorm1d(num_features=self.hidden_dim)
 
-        self.glbAvgPool = nn.AdaptiveAvgPool1d(1)
-
         self.dropout = nn.Dropout(DROPOUT)
         # The linear layer that maps from hidden state space to tag space
         self.lc1 = nn.Linear(hidden_dim, int(hidden_dim*2))
@@ -213,16 +437,7 @@ class cnn_2d(nn.Module):
     def forward(self, landmarks, lengths):
         landmarks = landmarks.permute(0, 2, 1)  # (b, seq, dim) --> (b, dim, seq)
         # Convolve on Seq for each dim to get (b, dim, seq)
-        if self.n_layers == 8:
-            landmarks = F.relu(self.bn8(self.conv8(F.relu(self.bn7(self.conv7(self.p3(F.relu(self.bn6(self.conv6(F.relu(self.bn5(self.conv5(self.p2(F.relu(self.bn4(self.conv4(F.relu(self.bn3(self.conv3(self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks)))))))))))))))))))))))))))
-        elif self.n_layers == 6:
-            landmarks = self.p3(F.relu(self.bn6(self.conv6(F.relu(self.bn5(self.conv5(self.p2(F.relu(self.bn4(self.conv4(F.relu(self.bn3(self.conv3(self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks)))))))))))))))))))))
-        elif self.n_layers == 4:
-            landmarks = self.p2(F.relu(self.bn4(self.conv4(F.relu(self.bn3(self.conv3(self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks))))))))))))))
-        elif self.n_layers == 2:
-            landmarks = self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks)))))))
-        else:
-            print('Not specify n_layers')
+        landmarks = self.conv_front(landmarks)
         # Permute back: (b, dim, d_seq) --> (b, seq, dim)
         landmarks = landmarks.permute(0, 2, 1)
         # flat it to feed into fc: (b x seq, dim)
@@ -234,26 +449,17 @@ class cnn_2d(nn.Module):
         # unflat back to (b, seq, 1)
         landmarks = landmarks.view(batch_size, seq_len, 1)
 
-        logit_list = []
-        if self.n_layers == 8 or self.n_layers == 6:
-            for i, landmark in enumerate(landmarks):
-                logit_list.append(self.glbAvgPool(landmark[:int(lengths[i]/8)].unsqueeze(0).permute(0, 2, 1)).squeeze(-1))
-        if self.n_layers == 4:
-            for i, landmark in enumerate(landmarks):
-                logit_list.append(self.glbAvgPool(landmark[:int(lengths[i]/4)].unsqueeze(0).permute(0, 2, 1)).squeeze(-1))
-        if self.n_layers == 2:
-            for i, landmark in enumerate(landmarks):
-                logit_list.append(self.glbAvgPool(landmark[:int(lengths[i]/2)].unsqueeze(0).permute(0, 2, 1)).squeeze(-1))
+        # average over the valid (pooled) frames of each sequence
+        return masked_mean(landmarks, pooled_lengths(torch.as_tensor(lengths), self.scale_pool))
 
-        return torch.cat(logit_list)
 
-
-class cnn_Classifier(nn.Module):
+class cnn_Classifier(SequenceModel):
 
     def __init__(self, embedding_dim, hidden_dim, target_size=1, bidirectional=False):
         super(cnn_Classifier, self).__init__()
         self.hidden_dim = hidden_dim # can change to smaller ones 64 . 32. 16
         self.n_layers = 2  # 2, 4, 6 ,8
+        self.check_n_layers()
         self.use_bn = False
         if self.n_layers >= 2:
             self.conv1 = nn.Conv2d(in_channels=1, out_channels=self.hidden_dim, kernel_size=3, padding=1)
@@ -262,6 +468,7 @@ class cnn_Classifier(nn.Module):
                 self.bn1 = nn.BatchNorm2d(num_features=self.hidden_dim)
                 self.bn2 = nn.BatchNorm2d(num_features=self.hidden_dim)
             self.p1 = nn.MaxPool2d(kernel_size=2)
+            self.scale_pool = 2
         if self.n_layers >= 4:
             self.conv3 = nn.Conv2d(in_channels=self.hidden_dim, out_channels=self.hidden_dim, kernel_size=3, padding=1)
             self.conv4 = nn.Conv2d(in_channels=self.hidden_dim, out_channels=self.hidden_dim, kernel_size=3, padding=1)
@@ -269,6 +476,7 @@ class cnn_Classifier(nn.Module):
                 self.bn3 = nn.BatchNorm2d(num_features=self.hidden_dim)
                 self.bn4 = nn.BatchNorm2d(num_features=self.hidden_dim)
             self.p2 = nn.MaxPool2d(kernel_size=2)
+            self.scale_pool = 4
         if self.n_layers >= 6:
             self.conv5 = nn.Conv2d(in_channels=self.hidden_dim, out_channels=self.hidden_dim, kernel_size=3, padding=1)
             self.conv6 = nn.Conv2d(in_channels=self.hidden_dim, out_channels=self.hidden_dim, kernel_size=3, padding=1)
@@ -276,12 +484,16 @@ class cnn_Classifier(nn.Module):
                 self.bn5 = nn.BatchNorm2d(num_features=self.hidden_dim)
                 self.bn6 = nn.BatchNorm2d(num_features=self.hidden_dim)
             self.p3 = nn.MaxPool2d(kernel_size=2)
+            self.scale_pool = 8
         if self.n_layers == 8:
             self.conv7 = nn.Conv2d(in_channels=self.hidden_dim, out_channels=self.hidden_dim, kernel_size=3, padding=1)
             self.conv8 = nn.Conv2d(in_channels=self.hidden_dim, out_channels=self.hidden_dim, kernel_size=3, padding=1)
             if self.use_bn:
                 self.bn7 = nn.BatchNorm2d(num_features=self.hidden_dim)
                 self.bn8 = nn.BatchNorm2d(num_features=self.hidden_dim)
+        if not self.use_bn:
+            for i in range(1, self.n_layers + 1):
+                setattr(self, 'bn%d' % i, nn.Identity())
 
         self.dropout = nn.Dropout(DROPOUT)
         # The linear layer that maps from hidden state space to tag space
@@ -289,31 +501,12 @@ class cnn_Classifier(nn.Module):
         self.lc2 = nn.Linear(int(hidden_dim*2), target_size)
 
     def forward(self, landmarks, lengths):
-        landmarks = landmarks.permute(0, 2, 1)  # (b, seq, dim) --> (b, dim, seq)
-        # Convolve on Seq for each dim to get (b, dim, seq)
-        if self.use_bn:
-            if self.n_layers == 8:
-                landmarks = F.relu(self.bn8(self.conv8(F.relu(self.bn7(self.conv7(self.p3(F.relu(self.bn6(self.conv6(F.relu(self.bn5(self.conv5(self.p2(F.relu(self.bn4(self.conv4(F.relu(self.bn3(self.conv3(self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks)))))))))))))))))))))))))))
-            elif self.n_layers == 6:
-                landmarks = self.p3(F.relu(self.bn6(self.conv6(F.relu(self.bn5(self.conv5(self.p2(F.relu(self.bn4(self.conv4(F.relu(self.bn3(self.conv3(self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks)))))))))))))))))))))
-            elif self.n_layers == 4:
-                landmarks = self.p2(F.relu(self.bn4(self.conv4(F.relu(self.bn3(self.conv3(self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks))))))))))))))
-            elif self.n_layers == 2:
-                landmarks = self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks)))))))
-            else:
-                print('Not specify n_layers')
-        else:
-            if self.n_layers == 8:
-                landmarks = F.relu(self.conv8(F.relu(self.conv7(self.p3(F.relu(self.conv6(F.relu(self.conv5(self.p2(F.relu(self.conv4(F.relu(self.conv3(self.p1(F.relu(self.conv2(F.relu(self.conv1(landmarks)))))))))))))))))))
-            elif self.n_layers == 6:
-                landmarks = self.p3(F.relu(self.conv6(F.relu(self.conv5(self.p2(F.relu(self.conv4(F.relu(self.conv3(self.p1(F.relu(self.conv2(F.relu(self.conv1(landmarks)))))))))))))))
-            elif self.n_layers == 4:
-                landmarks = self.p2(F.relu(self.conv4(F.relu(self.conv3(self.p1(F.relu(self.conv2(F.relu(self.conv1(landmarks))))))))))
-            elif self.n_layers == 2:
-                landmarks = self.p1(F.relu(self.conv2(F.relu(self.conv1(landmarks)))))
-            else:
-                print('Not specify n_layers')
-        # Permute back: (b, dim, d_seq) --> (b, seq, dim)
+        landmarks = landmarks.permute(0, 2, 1).unsqueeze(1)  # (b, seq, dim) --> (b, 1, dim, seq)
+        # Convolve on (dim, seq) to get (b, hidden, dim, seq)
+        landmarks = self.conv_front(landmarks)
+        # Average the pooled landmark axis: (b, hidden, d_dim, d_seq) --> (b, hidden, d_seq)
+        landmarks = landmarks.mean(2)
+        # Permute back: (b, hidden, d_seq) --> (b, d_seq, hidden)
         landmarks = landmarks.permute(0, 2, 1)
         # flat it to feed into fc: (b x seq, dim)
         landmarks = landmarks.contiguous()
@@ -324,26 +517,135 @@ class cnn_Classifier(nn.Module):
         # unflat back to (b, seq, 1)
         landmarks = landmarks.view(batch_size, seq_len, 1)
 
-        logit_list = []
-        if self.n_layers == 8 or self.n_layers == 6:
-            for i, landmark in enumerate(landmarks):
-                logit_list.append(self.glbAvgPool(landmark[:int(lengths[i]/8)].unsqueeze(0).permute(0, 2, 1)).squeeze(-1))
-        if self.n_layers == 4:
-            for i, landmark in enumerate(landmarks):
-                logit_list.append(self.glbAvgPool(landmark[:int(lengths[i]/4)].unsqueeze(0).permute(0, 2, 1)).squeeze(-1))
-        if self.n_layers == 2:
-            for i, landmark in enumerate(landmarks):
-                logit_list.append(self.glbAvgPool(landmark[:int(lengths[i]/2)].unsqueeze(0).permute(0, 2, 1)).squeeze(-1))
-
-        return torch.cat(logit_list)
-
-
-class crnn_Classifier(nn.Module):
+        # average over the valid (pooled) frames of each sequence
+        return masked_mean(landmarks, pooled_lengths(torch.as_tensor(lengths), self.scale_pool))
+
+
+def conv_stages(model):
+    # the Conv1d/BatchNorm/ReLU + MaxPool front-end of the crnn models in order:
+    # ('conv', conv, bn) for every conv layer, ('pool', pool, None) where the time axis is halved
+    stages = []
+    for i in range(1, model.n_layers + 1):
+        stages.append(('conv', getattr(model, 'conv%d' % i), getattr(model, 'bn%d' % i)))
+        if i % 2 == 0 and hasattr(model, 'p%d' % (i // 2)):
+            stages.append(('pool', getattr(model, 'p%d' % (i // 2)), None))
+    return stages
+
+
+def _stream_conv(conv, bn, buf, seen, slots, flush=False):
+    # buf holds the last two inputs (zeros before the first frame = the left padding), so output
+    # frame n-1 is complete once input n arrives; flush adds the last frame with zero right padding
+    out = []
+    for x, valid in slots:
+        y = F.relu(bn(F.conv1d(torch.stack((buf[0], buf[1], x), 2), conv.weight, conv.bias))).squeeze(2)
+        out.append((y, valid & (seen > 0)))
+        v = valid.unsqueeze(1)
+        buf = torch.stack((torch.where(v, buf[1], buf[0]), torch.where(v, x, buf[1])))
+        seen = seen + valid.long()
+    if flush:
+        y = F.relu(bn(F.conv1d(torch.stack((buf[0], buf[1], torch.zeros_like(buf[1])), 2), conv.weight, conv.bias)))
+        out.append((y.squeeze(2), seen > 0))
+    return out, buf, seen
+
+
+def _stream_pool(pending, has, slots):
+    # MaxPool1d(2): every second input closes a pair, an unpaired last frame is dropped like in forward
+    out = []
+    for x, valid in slots:
+        out.append((torch.max(pending, x), valid & has))
+        pending = torch.where((valid & ~has).unsqueeze(1), x, pending)
+        has = has ^ valid
+    return out, pending, has
+
+
+def _stream_front(model, state, slots, flush=False):
+    new_state = []
+    for k, (kind, layer, bn) in enumerate(conv_stages(model)):
+        a, b = state[2 * k], state[2 * k + 1][0]
+        if kind == 'conv':
+            slots, a, b = _stream_conv(layer, bn, a, b, slots, flush)
+        else:
+            slots, a, b = _stream_pool(a[0], b, slots)
+            a = a.unsqueeze(0)
+        new_state += [a, b.unsqueeze(0)]
+    return slots, new_state
+
+
+def _stream_gru(gru, h, slots):
+    out = []
+    for x, valid in slots:
+        o, h_new = gru(x.unsqueeze(0), h)
+        h = torch.where(valid.view(1, -1, 1), h_new, h)
+        out.append((o[0], valid))
+    return out, h
+
+
+def conv_stream_init(model, batch_size, device=None):
+    # state of conv_stream_step, every tensor with the batch on dim 1: per conv layer the last two
+    # inputs and the number of inputs seen, per pooling layer the unpaired frame and whether there
+    # is one, then the GRU hidden state, the number of pooled frames and their summed probability
+    state = []
+    dim = None
+    for kind, layer, _ in conv_stages(model):
+        if kind == 'conv':
+            dim = layer.out_channels
+            state += [torch.zeros((2, batch_size, layer.in_channels), device=device),
+                      torch.zeros((1, batch_size), dtype=torch.long, device=device)]
+        else:
+            state += [torch.zeros((1, batch_size, dim), device=device),
+                      torch.zeros((1, batch_size), dtype=torch.bool, device=device)]
+    state += [torch.zeros((model.gru.num_layers, batch_size, model.hidden_dim), device=device),
+              torch.zeros((1, batch_size), dtype=torch.long, device=device),
+              torch.zeros((1, batch_size), device=device)]
+    return tuple(state)
+
+
+def conv_stream_step(model, frames, state, lengths=None, head=None):
+    # Incremental forward of crnn_Classifier / FrameCRNN (eval mode) on the next frame(s), see
+    # recurrent_step. Pooled frames whose receptive field is complete go through the GRU for good;
+    # the few trailing ones that still depend on the zero right padding are run on a copy of the
+    # state, so the output equals forward() on everything seen so far at a constant cost per frame.
+    # head maps GRU outputs to per-frame logits for the framewise model (output: mean probability),
+    # without it the output is the logit of the last GRU state. NaN until one pooled frame exists.
+    if model.gru.bidirectional:
+        raise ValueError('bidirectional recurrent layers cannot be run incrementally')
+    if frames.dim() == 2:
+        frames = frames.unsqueeze(1)
+    valid = torch.ones(frames.shape[:2], dtype=torch.bool, device=frames.device)
+    if lengths is not None:
+        valid = length_mask(lengths, frames.shape[1], frames.device)
+    slots = [(frames[:, i], valid[:, i]) for i in range(frames.shape[1])]
+    h, n_pooled, prob_sum = state[-3], state[-2][0], state[-1][0]
+
+    slots, front = _stream_front(model, state, slots)
+    slots, h = _stream_gru(model.gru, h, slots)
+    for o, v in slots:
+        n_pooled = n_pooled + v.long()
+        if head is not None:
+            prob_sum = prob_sum + torch.sigmoid(head(o)).squeeze(1) * v
+    new_state = tuple(front) + (h, n_pooled.unsqueeze(0), prob_sum.unsqueeze(0))
+
+    # the tail, on copies
+    tail, _ = _stream_front(model, front, [], flush=True)
+    tail, h_tail = _stream_gru(model.gru, h, tail)
+    n_tail = n_pooled + sum(v.long() for _, v in tail)
+    if head is not None:
+        prob_tail = prob_sum + sum(torch.sigmoid(head(o)).squeeze(1) * v for o, v in tail)
+        out = (prob_tail / n_tail).unsqueeze(1)
+    else:
+        ht = model.dropout(h_tail[-1])
+        out = model.lc2(model.dropout(F.relu(model.lc1(ht))))
+    out = out.masked_fill((n_tail == 0).unsqueeze(1), float('nan'))
+    return out, new_state
+
+
+class crnn_Classifier(SequenceModel):
 
     def __init__(self, embedding_dim, hidden_dim, target_size=1, bidirectional=False, n_layer=1):
         super(crnn_Classifier, self).__init__()
         self.hidden_dim = hidden_dim
         self.n_layers = 4 # 2, 4, 6 ,8
+        self.check_n_layers()
         if self.n_layers >= 2:
             self.conv1 = nn.Conv1d(in_channels=embedding_dim, out_channels=hidden_dim, kernel_size=3, padding=1)
             self.conv2 = nn.Conv1d(in_channels=hidden_dim, out_channels=hidden_dim, kernel_size=3, padding=1)
@@ -382,38 +684,36 @@ class crnn_Classifier(nn.Module):
     def forward(self, landmarks, lengths):
         landmarks = landmarks.permute(0, 2, 1)  # (b, seq, dim) --> (b, dim, seq)
         # Convolve on Seq for each dim to get (b, dim, seq)
-        if self.n_layers == 8:
-            landmarks = F.relu(self.bn8(self.conv8(F.relu(self.bn7(self.conv7(self.p3(F.relu(self.bn6(self.conv6(F.relu(self.bn5(self.conv5(self.p2(F.relu(self.bn4(self.conv4(F.relu(self.bn3(self.conv3(self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks)))))))))))))))))))))))))))
-        elif self.n_layers == 6:
-            landmarks = self.p3(F.relu(self.bn6(self.conv6(F.relu(self.bn5(self.conv5(self.p2(F.relu(self.bn4(self.conv4(F.relu(self.bn3(self.conv3(self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks)))))))))))))))))))))
-        elif self.n_layers == 4:
-            landmarks = self.p2(F.relu(self.bn4(self.conv4(F.relu(self.bn3(self.conv3(self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks))))))))))))))
-        elif self.n_layers == 2:
-            landmarks = self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks)))))))
-        else:
-            print('Not specify n_layers')
+        landmarks = self.conv_front(landmarks)
 
         # Permute back: (b, dim, d_seq) --> (b, seq, dim) with shorter seq
         landmarks = landmarks.permute(0, 2, 1)
         # Feed into GRU
         # import pdb; pdb.set_trace()
         # packed_input = pack_padded_sequence(self.dropout(landmarks), torch.IntTensor(lengths)/self.scale_pool, batch_first=True)
-        packed_input = pack_padded_sequence(self.dropout(landmarks), tuple(int(x/self.scale_pool) for x in lengths), batch_first=True)
-        _, ht = self.gru(packed_input)
-        if ht.requires_grad:
-            ht.register_hook(lambda x: x.clamp(min=-self.grad_clipping, max=self.grad_clipping))
+        _, ht = self.run_gru(self.dropout(landmarks), pooled_lengths(torch.as_tensor(lengths), self.scale_pool))
+        if not torch.jit.is_scripting():
+            self.clip_grad(ht)
         ht = self.dropout(ht[-1])
         logit = F.relu(self.lc1(ht))
         logit = self.lc2(self.dropout(logit))
         return logit
 
-# to be implemented
-class FrameCRNN(nn.Module):
+    def init_state(self, batch_size, device=None):
+        return conv_stream_init(self, batch_size, device)
+
+    def step(self, frames, state, lengths=None):
+        # incremental forward: logit of every sequence so far and the new state, see conv_stream_step
+        return conv_stream_step(self, frames, state, lengths)
+
+
+class FrameCRNN(SequenceModel):
 
     def __init__(self, embedding_dim, hidden_dim, target_size=1, bidirectional=False, n_layer=1):
         super(FrameCRNN, self).__init__()
         self.hidden_dim = hidden_dim
         self.n_layers = 2  # 2, 4, 6 ,8
+        self.check_n_layers()
         if self.n_layers >= 2:
             self.conv1 = nn.Conv1d(in_channels=embedding_dim, out_channels=hidden_dim, kernel_size=3, padding=1)
             self.conv2 = nn.Conv1d(in_channels=hidden_dim, out_channels=hidden_dim, kernel_size=3, padding=1)
@@ -452,27 +752,56 @@ class FrameCRNN(nn.Module):
     def forward(self, landmarks, lengths):
         landmarks = landmarks.permute(0, 2, 1)  # (b, seq, dim) --> (b, dim, seq)
         # Convolve on Seq for each dim to get (b, dim, seq)
-        if self.n_layers == 8:
-            landmarks = F.relu(self.bn8(self.conv8(F.relu(self.bn7(self.conv7(self.p3(F.relu(self.bn6(self.conv6(F.relu(self.bn5(self.conv5(self.p2(F.relu(self.bn4(self.conv4(F.relu(self.bn3(self.conv3(self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks)))))))))))))))))))))))))))
-        elif self.n_layers == 6:
-            landmarks = self.p3(F.relu(self.bn6(self.conv6(F.relu(self.bn5(self.conv5(self.p2(F.relu(self.bn4(self.conv4(F.relu(self.bn3(self.conv3(self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks)))))))))))))))))))))
-        elif self.n_layers == 4:
-            landmarks = self.p2(F.relu(self.bn4(self.conv4(F.relu(self.bn3(self.conv3(self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks))))))))))))))
-        elif self.n_layers == 2:
-            landmarks = self.p1(F.relu(self.bn2(self.conv2(F.relu(self.bn1(self.conv1(landmarks)))))))
-        else:
-            print('Not specify n_layers')
+        landmarks = self.conv_front(landmarks)
 
         # Permute back: (b, dim, d_seq) --> (b, seq, dim) with shorter seq
         landmarks = landmarks.permute(0, 2, 1)
-        # Feed into GRU
-        packed_input = pack_padded_sequence(self.dropout(landmarks), torch.IntTensor(lengths)/self.scale_pool, batch_first=True)
-        _, ht = self.gru(packed_input)
-        ht = self.dropout(ht[-1])
-        logit = F.relu(self.lc1(ht))
+        # Feed into GRU, one logit per pooled frame: (b, max(lengths // scale_pool), 1)
+        output, _ = self.run_gru(self.dropout(landmarks), pooled_lengths(torch.as_tensor(lengths), self.scale_pool),
+                                 True)
+        output = self.dropout(output)
+        logit = F.relu(self.lc1(output))
         logit = self.lc2(self.dropout(logit))
         return logit
 
+    def _frame_logit(self, output):
+        return self.lc2(self.dropout(F.relu(self.lc1(self.dropout(output)))))
+
+    def init_state(self, batch_size, device=None):
+        return conv_stream_init(self, batch_size, device)
+
+    def step(self, frames, state, lengths=None):
+        # incremental forward: mean frame probability of every sequence so far (framewise_scores
+        # of forward) and the new state, see conv_stream_step
+        return conv_stream_step(self, frames, state, lengths, head=self._frame_logit)
+
+
+# name used by the training / test scripts --> class. FRAMEWISE models return one logit per
+# (pooled) frame, PACKED ones take the PackedSequence from collate.PadCollate(packed=True).
+MODELS = {
+    'frameGRU': Framewise_GRU_Classifier,
+    'frameCRNN': FrameCRNN,
+    'sumGRU': sumGRU,
+    'embedGRU': embed_GRU_Classifier,
+    'GRU': GRU_Classifier,
+    'biGRU': biGRU_Classifier,
+    'LSTM': LSTM_Classifier,
+    'cnn': cnn_Classifier,
+    '2dcnn': cnn_2d,
+    'crnn': crnn_Classifier,
+}
+FRAMEWISE = ('frameGRU', 'frameCRNN')
+PACKED = ('frameGRU', 'sumGRU', 'embedGRU', 'GRU', 'biGRU', 'LSTM')
+
+
+def build_model(rnn, embedding_dim, hidden_dim, target_size=1, n_layer=1):
+    """Instantiate MODELS[rnn]. 'cnn' and '2dcnn' have a fixed depth and ignore n_layer."""
+    if rnn not in MODELS:
+        raise ValueError('unknown model {!r}, expected one of {}'.format(rnn, ', '.join(MODELS)))
+    if rnn in ('cnn', '2dcnn'):
+        return MODELS[rnn](embedding_dim, hidden_dim, target_size)
+    return MODELS[rnn](embedding_dim, hidden_dim, target_size, n_layer=n_layer)
+
 
 
 
@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import torch
+
+from dataset import default_list_reader, default_loader, PACK_INDEX, shard_name
+
+
+def to_numpy(lm, dtype):
+    if torch.is_tensor(lm):
+        lm = lm.numpy()
+    return np.ascontiguousarray(lm, dtype=dtype)
+
+
+def pack(root, fileList, out_dir, shard_bytes=1 << 30, dtype='float32',
+         list_reader=default_list_reader, loader=default_loader):
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    lmList = list_reader(fileList)
+    n = len(lmList)
+    shard = np.zeros(n, dtype=np.int32)
+    offset = np.zeros(n, dtype=np.int64)
+    length = np.zeros(n, dtype=np.int64)
+    labels = np.zeros(n, dtype=np.int64)
+    dim = None
+
+    i_shard, rows, written = 0, 0, 0
+    fp = open(os.path.join(out_dir, shard_name(i_shard)), 'wb')
+    for i, (lmPath, target) in enumerate(lmList):
+        lm = to_numpy(loader(os.path.join(root, lmPath)), dtype)
+        if dim is None:
+            dim = lm.shape[1]
+        elif lm.shape[1] != dim:
+            raise ValueError('{} has feature dim {}, expected {}'.format(lmPath, lm.shape[1], dim))
+        # start a new shard once the current one is full; a sequence never spans two shards
+        if written > 0 and written + lm.nbytes > shard_bytes:
+            fp.close()
+            i_shard, rows, written = i_shard + 1, 0, 0
+            fp = open(os.path.join(out_dir, shard_name(i_shard)), 'wb')
+        fp.write(lm.tobytes())
+        shard[i], offset[i], length[i], labels[i] = i_shard, rows, lm.shape[0], target
+        rows += lm.shape[0]
+        written += lm.nbytes
+    fp.close()
+
+    np.savez(os.path.join(out_dir, PACK_INDEX), paths=np.array([p for p, _ in lmList]), labels=labels,
+             shard=shard, offset=offset, length=length, dim=dim if dim is not None else 0,
+             dtype=np.dtype(dtype).name)
+    return i_shard + 1, n
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Pack a landmark file list into memory-mappable shards')
+    parser.add_argument('root', help='data root, e.g. /datasets/move_closer/Data_Distortion/')
+    parser.add_argument('file_list', help='list file, e.g. /datasets/move_closer/TrainList.txt')
+    parser.add_argument('out_dir', help='output directory for the shards and index.npz')
+    parser.add_argument('--shard-size', type=int, default=1024, help='max shard size in MB')
+    parser.add_argument('--dtype', default='float32')
+    args = parser.parse_args(argv[1:])
+
+    n_shards, n = pack(args.root, args.file_list, args.out_dir, args.shard_size << 20, args.dtype)
+    print('packed {} sequences into {} shards in {}'.format(n, n_shards, args.out_dir))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
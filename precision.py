@@ -0,0 +1,36 @@
+import contextlib
+
+import torch
+
+
+# float32: plain training. bfloat16: autocast (CPU or GPU), same exponent range as float32, so no
+# loss scaling. float16: autocast with a GradScaler against gradient underflow (GPU).
+PRECISIONS = ('float32', 'bfloat16', 'float16')
+
+
+def autocast(device, precision='float32'):
+    # context for forward and loss; matmuls / convs / RNN layers run in `precision`, the losses stay float32
+    if precision not in PRECISIONS:
+        raise ValueError('precision must be one of {}, got {!r}'.format(', '.join(PRECISIONS), precision))
+    if precision == 'float32':
+        return contextlib.nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=getattr(torch, precision))
+
+
+def grad_scaler(device, precision='float32'):
+    return torch.amp.GradScaler(torch.device(device).type, enabled=precision == 'float16')
+
+
+def backward(model, loss, scaler):
+    # loss.backward() through the scaler. The grad_clipping hooks (GRU_Classifier, biGRU_Classifier,
+    # crnn_Classifier) see scaled gradients, so they clamp at grad_clipping times the current scale,
+    # which is the same clamp on the unscaled gradient.
+    if scaler.is_enabled():
+        model.grad_scale = scaler.get_scale()
+    scaler.scale(loss).backward()
+
+
+def step(optimizer, scaler):
+    # optimizer.step(); with float16 skips steps with inf / nan gradients and adapts the scale
+    scaler.step(optimizer)
+    scaler.update()
@@ -0,0 +1,104 @@
+import argparse
+import sys
+import time
+
+import torch
+from torch.utils import data
+
+from collate import PadCollate
+from dataset import LandmarkList
+from device import setup_device
+from model import FRAMEWISE, MODELS, PACKED, batch_loss, build_model, count_correct
+from precision import PRECISIONS, autocast, backward, grad_scaler, step
+
+
+EMBEDDING_DIM = int(68 * 67 /2)
+HIDDEN_DIM = 128
+
+
+def load_batches(root, file_list, collate_fn, batch_size, device, limit=0):
+    # collated once and kept on the device, so the timings below cover compute only
+    loader = data.DataLoader(LandmarkList(root=root, fileList=file_list), batch_size=batch_size, shuffle=False,
+                             num_workers=0, collate_fn=collate_fn)
+    batches = []
+    for batch, labels, lengths in loader:
+        batches.append((batch.to(device), torch.as_tensor(labels).to(device), lengths))
+        if limit and len(batches) == limit:
+            break
+    return batches
+
+
+def train(model, batches, optimizer, scaler, device, precision, framewise, epochs):
+    # --> sequences per second
+    model.train()
+    n, start = 0, time.time()
+    for _ in range(epochs):
+        for batch, labels, lengths in batches:
+            model.zero_grad()
+            with autocast(device, precision):
+                out = model(batch, lengths).float()
+            loss = batch_loss(model, out, labels, lengths, framewise)[0]
+            backward(model, loss, scaler)
+            step(optimizer, scaler)
+            n += len(lengths)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return n / (time.time() - start)
+
+
+def evaluate(model, batches, device, precision, framewise):
+    # --> accuracy (%), summed loss, sequences per second
+    model.eval()
+    correct, total_loss, n, start = 0, 0., 0, time.time()
+    with torch.no_grad():
+        for batch, labels, lengths in batches:
+            with autocast(device, precision):
+                out = model(batch, lengths).float()
+            loss, scores, _ = batch_loss(model, out, labels, lengths, framewise, reduction='sum')
+            total_loss += loss.item()
+            correct += count_correct(scores, labels).item()
+            n += len(lengths)
+    return correct / max(n, 1) * 100, total_loss, n / (time.time() - start)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Training / evaluation throughput and accuracy per precision')
+    parser.add_argument('rnn', choices=list(MODELS))
+    parser.add_argument('--root', default='/datasets/move_closer/Data_Distortion/')
+    parser.add_argument('--train-list', default='/datasets/move_closer/TrainList.txt')
+    parser.add_argument('--test-list', default='/datasets/move_closer/TestList.txt')
+    parser.add_argument('--precisions', type=lambda s: s.split(','), default=['float32', 'bfloat16'])
+    parser.add_argument('--device', default='cpu', help="GPU index, 'cuda:N' or 'cpu'")
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--embedding-dim', type=int, default=EMBEDDING_DIM)
+    parser.add_argument('--hidden-dim', type=int, default=HIDDEN_DIM)
+    parser.add_argument('--layers', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--train-batches', type=int, default=20, help='training batches per epoch (0: whole list)')
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--lr', type=float, default=1e-4)
+    args = parser.parse_args(argv[1:])
+    for precision in args.precisions:
+        if precision not in PRECISIONS:
+            parser.error('unknown precision {!r}, expected {}'.format(precision, ', '.join(PRECISIONS)))
+
+    device = setup_device(int(args.device) if args.device.isdigit() else args.device, args.threads)
+    framewise = args.rnn in FRAMEWISE
+    collate_fn = PadCollate(packed=args.rnn in PACKED)
+    train_batches = load_batches(args.root, args.train_list, collate_fn, args.batch_size, device, args.train_batches)
+    test_batches = load_batches(args.root, args.test_list, collate_fn, args.batch_size, device)
+
+    print('precision,train_seq_per_s,eval_seq_per_s,valid_acc,valid_loss')
+    for precision in args.precisions:
+        # every precision starts from the same weights and sees the same dropout masks and batches
+        torch.manual_seed(0)
+        model = build_model(args.rnn, args.embedding_dim, args.hidden_dim, 1, n_layer=args.layers).to(device)
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+        train_speed = train(model, train_batches, optimizer, grad_scaler(device, precision), device, precision,
+                            framewise, args.epochs)
+        acc, loss, eval_speed = evaluate(model, test_batches, device, precision, framewise)
+        print('{},{:.1f},{:.1f},{:.2f}%,{:.8f}'.format(precision, train_speed, eval_speed, acc, loss))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
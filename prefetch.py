@@ -0,0 +1,107 @@
+import queue
+import threading
+import time
+
+import torch
+from torch.nn.utils.rnn import PackedSequence
+
+
+_END = object()
+
+
+class _Failure(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class Prefetcher(object):
+    # Wraps a DataLoader yielding (batch, labels, lengths, ...). A background thread pulls the
+    # next `depth` batches, turns labels into a tensor, pins the batch and copies both to `device`
+    # on a side CUDA stream, so loading, collation and the host-to-device copy overlap compute.
+    # On CPU the thread still overlaps loading with compute. lengths and extra fields stay on
+    # the host (pack_padded_sequence wants CPU lengths).
+    # wait_time is the time the consumer spent blocked on data in the last pass.
+    def __init__(self, loader, device, depth=2, pin_memory=True):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.pin_memory = pin_memory and self.device.type == 'cuda'
+        self.wait_time = 0.
+        self.n_batches = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, x):
+        # PackedSequence.to moves data and both index tensors; batch_sizes stays on the host
+        if self.pin_memory and not (x.data if isinstance(x, PackedSequence) else x).is_pinned():
+            x = x.pin_memory()
+        return x.to(self.device, non_blocking=True)
+
+    def _stage(self, batch):
+        labels = batch[1] if torch.is_tensor(batch[1]) else torch.as_tensor(batch[1])
+        return (self._to_device(batch[0]), self._to_device(labels)) + tuple(batch[2:])
+
+    @staticmethod
+    def _put(out, item, stop):
+        # False once the consumer has left; a blocking put could wait forever on a full queue
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, out, stop):
+        try:
+            stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+            for batch in self.loader:
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = self._stage(batch)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = self._stage(batch)
+                if not self._put(out, (batch, event), stop):
+                    return
+            self._put(out, (_END, None), stop)
+        except Exception as exc:
+            self._put(out, (_Failure(exc), None), stop)
+
+    def __iter__(self):
+        out = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(out, stop), daemon=True)
+        thread.start()
+        self.wait_time, self.n_batches = 0., 0
+        try:
+            while True:
+                start = time.time()
+                batch, event = out.get()
+                self.wait_time += time.time() - start
+                if batch is _END:
+                    return
+                if isinstance(batch, _Failure):
+                    raise batch.exc
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    for x in batch[:2]:
+                        if isinstance(x, PackedSequence):
+                            for t in (x.data, x.sorted_indices, x.unsorted_indices):
+                                if t is not None:
+                                    t.record_stream(current)
+                        else:
+                            x.record_stream(current)
+                self.n_batches += 1
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+    def report(self, elapsed):
+        return 'data wait {:.2f}s of {:.2f}s ({:.1f}%) over {} batches'.format(
+            self.wait_time, elapsed, 100. * self.wait_time / max(elapsed, 1e-12), self.n_batches)
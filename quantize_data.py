@@ -0,0 +1,110 @@
+import argparse
+import os
+import pickle
+import sys
+
+import numpy as np
+import torch
+from torch.utils import data
+
+from collate import PadCollate
+from dataset import LandmarkList, default_list_reader, default_loader, quantized_loader
+from model import biGRU_Classifier
+
+
+EMBEDDING_DIM = int(68 * 67 /2)
+HIDDEN_DIM = 128
+N_LAYERS_RNN = 3
+
+
+def quantize(lm, dtype='int16'):
+    # float16: plain cast. int16: per-file affine map of [min, max] onto [-32767, 32767].
+    if torch.is_tensor(lm):
+        lm = lm.numpy()
+    lm = np.asarray(lm, dtype=np.float32)
+    if dtype == 'float16':
+        return {'data': lm.astype(np.float16), 'scale': 1., 'offset': 0.}
+    if dtype != 'int16':
+        raise ValueError('unsupported dtype {}'.format(dtype))
+    lo, hi = (float(lm.min()), float(lm.max())) if lm.size else (0., 0.)
+    offset = (hi + lo) / 2.
+    scale = (hi - lo) / 65534. if hi > lo else 1.
+    q = np.clip(np.rint((lm - offset) / scale), -32767, 32767).astype(np.int16)
+    return {'data': q, 'scale': scale, 'offset': offset}
+
+
+def export(root, fileList, out_root, dtype='int16'):
+    lmList = default_list_reader(fileList)
+    for lmPath, _ in lmList:
+        out_path = os.path.join(out_root, lmPath)
+        if not os.path.isdir(os.path.dirname(out_path)):
+            os.makedirs(os.path.dirname(out_path))
+        with open(out_path, 'wb') as fp:
+            pickle.dump(quantize(default_loader(os.path.join(root, lmPath)), dtype), fp, protocol=pickle.HIGHEST_PROTOCOL)
+    return len(lmList)
+
+
+def max_error(root, quant_root, fileList):
+    max_abs, max_rel = 0., 0.
+    for lmPath, _ in default_list_reader(fileList):
+        lm = torch.as_tensor(default_loader(os.path.join(root, lmPath))).float()
+        err = (quantized_loader(os.path.join(quant_root, lmPath)).dequantize() - lm).abs().max().item()
+        max_abs = max(max_abs, err)
+        max_rel = max(max_rel, err / max(lm.abs().max().item(), 1e-12))
+    return max_abs, max_rel
+
+
+def accuracy(model, data_loader, device):
+    correct_pred, num_examples = 0, 0
+    model.eval()
+    with torch.no_grad():
+        for batch, labels, lengths in data_loader:
+            logits = model(batch.to(device), lengths)
+            predicted_labels = (torch.sigmoid(logits) > 0.5).long().squeeze(1).cpu()
+            correct_pred += (predicted_labels == torch.LongTensor(labels)).sum().item()
+            num_examples += len(labels)
+    return correct_pred / num_examples * 100
+
+
+def validate(root, quant_root, fileList, checkpoint, batch_size=64):
+    max_abs, max_rel = max_error(root, quant_root, fileList)
+    print('max_abs_error,{:.8f},max_rel_error,{:.8f}'.format(max_abs, max_rel))
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = biGRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+    model = model.to(device)
+    collate_fn = PadCollate(packed=True)
+    accs = []
+    for data_root, loader in ((root, default_loader), (quant_root, quantized_loader)):
+        dataset = LandmarkList(root=data_root, fileList=fileList, loader=loader)
+        accs.append(accuracy(model, data.DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn), device))
+    print('float_acc,{:.2f}%,quantized_acc,{:.2f}%,delta,{:+.2f}%'.format(accs[0], accs[1], accs[1] - accs[0]))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Reduced-precision landmark storage')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('export', help='write float16 / int16 copies of every file in a list')
+    p.add_argument('root')
+    p.add_argument('file_list')
+    p.add_argument('out_root')
+    p.add_argument('--dtype', default='int16', choices=['int16', 'float16'])
+    p = sub.add_parser('validate', help='max error and biGRU accuracy delta of an exported copy')
+    p.add_argument('root')
+    p.add_argument('quant_root')
+    p.add_argument('file_list', help='e.g. /datasets/move_closer/TestList.txt')
+    p.add_argument('--checkpoint', default='models/biGRU_L' + str(N_LAYERS_RNN) + '.pt')
+    args = parser.parse_args(argv[1:])
+
+    if args.command == 'export':
+        n = export(args.root, args.file_list, args.out_root, args.dtype)
+        print('exported {} files as {} to {}'.format(n, args.dtype, args.out_root))
+    elif args.command == 'validate':
+        validate(args.root, args.quant_root, args.file_list, args.checkpoint)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
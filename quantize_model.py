@@ -0,0 +1,92 @@
+import argparse
+import io
+import sys
+
+import torch
+import torch.nn as nn
+from torch.utils import data
+
+from collate import PadCollate
+from dataset import LandmarkListTest
+from export_model import example_inputs, latency
+from metrics import collect_scores, threshold_sweep, roc_curve, equal_error_rate
+from model import PACKED, build_model
+
+
+EMBEDDING_DIM = int(68 * 67 /2)
+HIDDEN_DIM = 128
+N_LAYERS_RNN = 3
+# recurrent classifiers whose cost sits in nn.GRU / nn.LSTM / nn.Linear
+QUANTIZABLE = ('GRU', 'biGRU', 'LSTM', 'sumGRU', 'embedGRU')
+
+
+def quantize(model):
+    # int8 weights, activations quantized on the fly per batch (CPU only)
+    return torch.ao.quantization.quantize_dynamic(model.cpu().eval(), {nn.GRU, nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def load_quantized(rnn, path, embedding_dim, hidden_dim, n_layer=1):
+    # state_dict written by this script
+    model = quantize(build_model(rnn, embedding_dim, hidden_dim, 1, n_layer=n_layer))
+    model.load_state_dict(torch.load(path, weights_only=False))
+    return model
+
+
+def model_size(model):
+    # bytes of the serialized state_dict
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell()
+
+
+def evaluate(model, data_loader):
+    # accuracy / FP / FN at 0.5 and EER, as printed by test.py
+    scores, labels, _ = collect_scores(model, data_loader, torch.device('cpu'))
+    acc, FP, FN = threshold_sweep(scores, labels, [0.5])
+    return float(acc[0]), int(FP[0]), int(FN[0]), equal_error_rate(*roc_curve(scores, labels)[1:])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Dynamic int8 quantization of a trained recurrent classifier')
+    parser.add_argument('rnn', choices=QUANTIZABLE)
+    parser.add_argument('checkpoint', help='state_dict saved by train.py, e.g. models/biGRU_L3.pt')
+    parser.add_argument('out', help='quantized state_dict, load with quantize_model.load_quantized')
+    parser.add_argument('--root', default='/datasets/move_closer/Data_Distortion/')
+    parser.add_argument('--file-list', default='/datasets/move_closer/TestList.txt')
+    parser.add_argument('--embedding-dim', type=int, default=EMBEDDING_DIM)
+    parser.add_argument('--hidden-dim', type=int, default=HIDDEN_DIM)
+    parser.add_argument('--layers', type=int, default=N_LAYERS_RNN)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--latency-batch-sizes', type=lambda s: [int(x) for x in s.split(',')], default=[1, 64])
+    parser.add_argument('--frames', type=int, default=300, help='frames per sequence of the latency batches')
+    parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads (0: torch default)')
+    args = parser.parse_args(argv[1:])
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = build_model(args.rnn, args.embedding_dim, args.hidden_dim, 1, n_layer=args.layers)
+    model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    model = model.eval()
+    qmodel = quantize(model)
+    torch.save(qmodel.state_dict(), args.out)
+
+    size, qsize = model_size(model), model_size(qmodel)
+    print('size_mb,float,{:.2f},int8,{:.2f},ratio,{:.2f}x'.format(size / 2. ** 20, qsize / 2. ** 20, size / qsize))
+    for batch_size in args.latency_batch_sizes:
+        landmarks, lengths = example_inputs(batch_size, args.frames, args.embedding_dim)
+        ms, qms = latency(model, landmarks, lengths), latency(qmodel, landmarks, lengths)
+        print('latency_ms,batch,{},frames,{},float,{:.2f},int8,{:.2f},speedup,{:.2f}x'.format(
+            batch_size, args.frames, ms, qms, ms / qms))
+
+    collate_fn = PadCollate(packed=args.rnn in PACKED, sort=False)
+    dataset = LandmarkListTest(root=args.root, fileList=args.file_list)
+    data_loader = data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=0, collate_fn=collate_fn)
+    results = [evaluate(m, data_loader) for m in (model, qmodel)]
+    for name, (acc, fp, fn, eer) in zip(('float', 'int8'), results):
+        print('{},valid_acc,{:.2f}%,valid_fp,{},valid_fn,{},valid_eer,{:.2f}%'.format(name, acc, fp, fn, eer))
+    print('delta,valid_acc,{:+.2f}%,valid_eer,{:+.2f}%'.format(results[1][0] - results[0][0], results[1][3] - results[0][3]))
+    print('saved {} int8 model to {}'.format(args.rnn, args.out))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
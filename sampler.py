@@ -0,0 +1,80 @@
+import numpy as np
+from torch.utils import data
+
+
+def dataset_lengths(dataset):
+    # PackedLandmarkList (and anything else exposing .lengths) answers instantly,
+    # otherwise every sample is read once
+    lengths = getattr(dataset, 'lengths', None)
+    if lengths is not None:
+        return np.asarray(lengths, dtype=np.int64)
+    return np.array([dataset[i][2] for i in range(len(dataset))], dtype=np.int64)
+
+
+def padding_efficiency(lengths):
+    # real frames / frames after padding every sequence to the longest in the batch
+    lengths = [int(x) for x in lengths]
+    return sum(lengths), len(lengths) * max(lengths)
+
+
+class BucketBatchSampler(data.Sampler):
+    # Shuffles the dataset, cuts it into pools of bucket_size samples, sorts every pool by
+    # length and slices it into batches, then shuffles the batch order. Batches hold sequences
+    # of similar length while the composition still changes every epoch.
+    # With max_frames set, a batch is closed once batch_len * longest_len would exceed it.
+    # Call set_epoch() each epoch to reshuffle, as with DistributedSampler.
+    # drop_last drops the final batch of the last pool when it holds fewer than batch_size sequences,
+    # with or without max_frames.
+    def __init__(self, lengths, batch_size=128, max_frames=None, bucket_size=None, shuffle=True,
+                 drop_last=False, seed=0):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_frames = max_frames
+        self.bucket_size = bucket_size if bucket_size is not None else batch_size * 50
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self._cache = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self, epoch):
+        rng = np.random.RandomState(self.seed + epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            pool = order[start:start + self.bucket_size]
+            pool = pool[np.argsort(-self.lengths[pool], kind='stable')]
+            batch, longest = [], 0
+            for idx in pool:
+                longest_new = max(longest, self.lengths[idx])
+                full = len(batch) == self.batch_size
+                if self.max_frames is not None and batch:
+                    full = full or (len(batch) + 1) * longest_new > self.max_frames
+                if full:
+                    batches.append(batch)
+                    batch, longest_new = [], self.lengths[idx]
+                batch.append(int(idx))
+                longest = longest_new
+            if batch:
+                batches.append(batch)
+        # only the leftover of the last pool is incomplete; the short tails of the other pools stay
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def _epoch_batches(self):
+        # built once per epoch, so len() matches what the iteration yields in max_frames mode
+        if self._cache is None or self._cache[0] != self.epoch:
+            self._cache = (self.epoch, self._batches(self.epoch))
+        return self._cache[1]
+
+    def __iter__(self):
+        return iter(self._epoch_batches())
+
+    def __len__(self):
+        return len(self._epoch_batches())
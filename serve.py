@@ -0,0 +1,269 @@
+import argparse
+import collections
+import json
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from collate import PadCollate
+from metrics import sequence_scores
+from model import FRAMEWISE, PACKED, build_model
+
+
+def load_model(rnn, checkpoint, embedding_dim, hidden_dim, n_layer=1, device='cpu'):
+    # any classifier in model.py from a state_dict saved by train.py
+    model = build_model(rnn, embedding_dim, hidden_dim, 1, n_layer=n_layer)
+    model.load_state_dict(torch.load(checkpoint, map_location=device))
+    return model.to(device).eval()
+
+
+class _Request(object):
+    __slots__ = ('landmarks', 'length', 'future', 'submitted')
+
+    def __init__(self, landmarks):
+        self.landmarks = landmarks
+        self.length = landmarks.shape[0]
+        self.future = Future()
+        self.submitted = time.perf_counter()
+
+
+class InferenceServer(object):
+    # Scores variable-length landmark sequences for any number of caller threads with one model.
+    # A worker thread takes the oldest waiting request and keeps collecting for up to max_wait_ms
+    # after it arrived (or until max_batch requests are in), then takes everything else already
+    # queued, sorts the lot by length and runs it as batches of similar length, each holding at
+    # most max_batch sequences and, with max_frames set, at most max_frames padded frames.
+    # submit() rejects sequences the model cannot take (feature width other than input_dim, if
+    # given, or fewer frames than one pooling window of the conv models), and a batch that still
+    # fails is rescored request by request, so an error only reaches the request that caused it.
+    def __init__(self, model, rnn, device='cpu', max_batch=64, max_wait_ms=5., max_frames=None, history=100000,
+                 input_dim=None):
+        self.model = model.eval()
+        self.input_dim = input_dim
+        self.min_frames = getattr(model, 'scale_pool', 1)
+        self.device = torch.device(device)
+        self.framewise = rnn in FRAMEWISE
+        self.collate_fn = PadCollate(packed=rnn in PACKED, sort=False)
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.
+        self.max_frames = max_frames
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=history)  # seconds, submit to result
+        self.batch_sizes = collections.deque(maxlen=history)
+        self.n_requests, self.n_batches, self.n_failed = 0, 0, 0
+        self.n_frames, self.n_padded_frames = 0, 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='InferenceServer', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        # requests queued before stop() are still answered
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def submit(self, landmarks):
+        # (frames, dim) array-like --> Future with the sequence score (sigmoid output)
+        lm = torch.as_tensor(landmarks, dtype=torch.float32)
+        if lm.dim() != 2 or lm.shape[0] == 0:
+            raise ValueError('expected a non-empty (frames, dim) sequence, got shape {}'.format(tuple(lm.shape)))
+        if self.input_dim is not None and lm.shape[1] != self.input_dim:
+            raise ValueError('expected {} features per frame, got {}'.format(self.input_dim, lm.shape[1]))
+        if lm.shape[0] < self.min_frames:
+            raise ValueError('expected at least {} frames, got {}'.format(self.min_frames, lm.shape[0]))
+        if self._thread is None:
+            raise RuntimeError('InferenceServer is not running, call start() first')
+        req = _Request(lm)
+        self._queue.put(req)
+        return req.future
+
+    def predict(self, landmarks, timeout=None):
+        return self.submit(landmarks).result(timeout)
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        pending = [first]
+        stop = False
+        deadline = first.submitted + self.max_wait
+        while len(pending) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                req = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if req is None:
+                stop = True
+                break
+            pending.append(req)
+        # whatever queued up meanwhile is batched by length together with it
+        while not stop and len(pending) < 8 * self.max_batch:
+            try:
+                req = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if req is None:
+                stop = True
+                break
+            pending.append(req)
+        if stop:
+            self._queue.put(None)
+        return pending
+
+    def _batches(self, pending):
+        pending.sort(key=lambda r: r.length)
+        batch = []
+        for req in pending:
+            # ascending lengths: req is the longest of the batch it joins
+            if batch and (len(batch) == self.max_batch or
+                          self.max_frames and (len(batch) + 1) * req.length > self.max_frames):
+                yield batch
+                batch = []
+            batch.append(req)
+        if batch:
+            yield batch
+
+    def _loop(self):
+        while True:
+            pending = self._collect()
+            if pending is None:
+                return
+            for batch in self._batches(pending):
+                self._score(batch)
+
+    def _score(self, batch):
+        try:
+            lms, _, lens = self.collate_fn([(r.landmarks, 0, r.length) for r in batch])
+            with torch.no_grad():
+                scores = sequence_scores(self.model, lms.to(self.device), lens, self.framewise).float().cpu().tolist()
+        except Exception as e:
+            if len(batch) > 1:
+                for r in batch:
+                    self._score([r])
+                return
+            with self._lock:
+                self.n_failed += 1
+            batch[0].future.set_exception(e)
+            return
+        done = time.perf_counter()
+        with self._lock:
+            self.n_requests += len(batch)
+            self.n_batches += 1
+            self.batch_sizes.append(len(batch))
+            self.n_frames += sum(r.length for r in batch)
+            self.n_padded_frames += len(batch) * batch[-1].length
+            self.latencies.extend(done - r.submitted for r in batch)
+        for r, s in zip(batch, scores):
+            r.future.set_result(s)
+
+    def stats(self):
+        with self._lock:
+            latencies = np.array(self.latencies) * 1000.
+            sizes = np.array(self.batch_sizes)
+            stats = {'requests': self.n_requests, 'failed': self.n_failed, 'batches': self.n_batches,
+                     'padding_efficiency': self.n_frames / max(self.n_padded_frames, 1)}
+        stats['mean_batch'] = float(sizes.mean()) if len(sizes) else 0.
+        stats['batch_fill'] = stats['mean_batch'] / self.max_batch
+        for p in (50, 90, 99):
+            stats['p{}_ms'.format(p)] = float(np.percentile(latencies, p)) if len(latencies) else 0.
+        stats['max_ms'] = float(latencies.max()) if len(latencies) else 0.
+        return stats
+
+    def report(self):
+        s = self.stats()
+        return ('{requests} requests in {batches} batches ({failed} failed), mean batch {mean_batch:.1f} '
+                '({batch_fill:.0%} full), padding efficiency {padding_efficiency:.0%}, latency p50 {p50_ms:.2f}ms '
+                'p90 {p90_ms:.2f}ms p99 {p99_ms:.2f}ms max {max_ms:.2f}ms').format(**s)
+
+
+def make_handler(server):
+    # POST /predict {"landmarks": [[...], ...]} or {"batch": [sequence, ...]} --> {"scores": [...]}
+    # GET /stats --> InferenceServer.stats()
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+            self._reply(200, server.stats())
+
+        def do_POST(self):
+            if self.path != '/predict':
+                return self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                sequences = body['batch'] if 'batch' in body else [body['landmarks']]
+                futures = [server.submit(np.asarray(s, dtype=np.float32)) for s in sequences]
+            except (ValueError, KeyError, TypeError) as e:
+                return self._reply(400, {'error': str(e)})
+            try:
+                self._reply(200, {'scores': [f.result() for f in futures]})
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Serve a trained classifier over HTTP with dynamic batching')
+    parser.add_argument('rnn', help='model name as in train.py, e.g. biGRU')
+    parser.add_argument('checkpoint', help='state_dict saved by train.py, e.g. models/biGRU_L3.pt')
+    parser.add_argument('--embedding-dim', type=int, default=2278)
+    parser.add_argument('--hidden-dim', type=int, default=128)
+    parser.add_argument('--layers', type=int, default=1)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=5.)
+    parser.add_argument('--max-frames', type=int, default=None, help='cap on batch size x longest sequence')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args(argv[1:])
+
+    model = load_model(args.rnn, args.checkpoint, args.embedding_dim, args.hidden_dim, args.layers, args.device)
+    server = InferenceServer(model, args.rnn, args.device, args.max_batch, args.max_wait_ms, args.max_frames,
+                             input_dim=args.embedding_dim)
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(server))
+    print('serving {} on http://{}:{}/predict'.format(args.rnn, args.host, args.port))
+    with server:
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+    print(server.report())
+
+
+if __name__ == "__main__":
+    main(sys.argv)
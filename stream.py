@@ -0,0 +1,67 @@
+import torch
+
+from collate import pad_batch
+
+
+def _cat_state(states):
+    # per-session states --> one batched state; every state tensor has the batch on dim 1
+    if torch.is_tensor(states[0]):
+        return torch.cat(states, 1)
+    return tuple(_cat_state(list(parts)) for parts in zip(*states))
+
+
+def _split_state(state):
+    if torch.is_tensor(state):
+        return list(state.split(1, 1))
+    return list(zip(*[_split_state(part) for part in state]))
+
+
+class StreamScorer(object):
+    # Scores live sequences (sessions) frame by frame with a model that has init_state / step
+    # (GRU_Classifier, LSTM_Classifier, embed_GRU_Classifier, crnn_Classifier, FrameCRNN). Only the
+    # state of each session is kept (hidden state, plus conv / pooling buffers for the crnn models),
+    # so a new frame costs O(1) instead of re-running the whole history, and all sessions that
+    # received frames in one push() are advanced in a single batched step.
+    # The scores equal the offline forward on everything a session has seen so far; the crnn
+    # models score NaN until a session has scale_pool frames.
+    # framewise models (FrameCRNN) already return the score from step.
+    def __init__(self, model, device='cpu', framewise=False):
+        self.model = model.eval()
+        self.framewise = framewise
+        self.device = torch.device(device)
+        self.states = {}
+        self.n_frames = {}
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, session):
+        return session in self.states
+
+    def close(self, session):
+        self.states.pop(session)
+        return self.n_frames.pop(session)
+
+    def push(self, frames):
+        # {session: new frames, (dim,) or (t, dim)} --> {session: score of the sequence so far};
+        # unknown sessions are opened with a fresh state
+        sessions = list(frames)
+        if not sessions:
+            return {}
+        chunks = []
+        for session in sessions:
+            chunk = torch.as_tensor(frames[session], dtype=torch.float32)
+            chunks.append(chunk.unsqueeze(0) if chunk.dim() == 1 else chunk)
+        lengths = [chunk.shape[0] for chunk in chunks]
+        if min(lengths) == 0:
+            raise ValueError('every pushed session needs at least one new frame')
+        batch = pad_batch(chunks, lengths).to(self.device)
+        states = [self.states[s] if s in self.states else self.model.init_state(1, self.device) for s in sessions]
+        with torch.no_grad():
+            # equal chunk sizes (the usual one frame per session) skip packing
+            out, state = self.model.step(batch, _cat_state(states), None if min(lengths) == max(lengths) else lengths)
+        for session, s, n in zip(sessions, _split_state(state), lengths):
+            self.states[session] = s
+            self.n_frames[session] = self.n_frames.get(session, 0) + n
+        scores = out if self.framewise else torch.sigmoid(out)
+        return dict(zip(sessions, scores.squeeze(1).tolist()))
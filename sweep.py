@@ -0,0 +1,140 @@
+import argparse
+import csv
+import itertools
+import os
+import queue
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from device import available_cpus
+
+
+# one row per run in results.csv, best first
+FIELDS = ('rnn', 'layers', 'hidden_dim', 'lr', 'best_valid_acc', 'best_valid_loss', 'best_epoch', 'train_acc',
+          'epochs', 'seconds', 'returncode', 'checkpoint', 'log')
+
+
+def grid(rnns, layers, hidden_dims, lrs):
+    return [dict(rnn=r, layers=n, hidden_dim=h, lr=lr) for r, n, h, lr in itertools.product(rnns, layers, hidden_dims, lrs)]
+
+
+def run_name(run):
+    return '{rnn}_L{layers}_H{hidden_dim}_lr{lr:g}'.format(**run)
+
+
+def parse_log(path):
+    # best validation (by valid_acc) of the 'Epoch' / 'Step' lines train.py prints
+    best = {'best_valid_acc': None, 'best_valid_loss': None, 'best_epoch': None, 'train_acc': None, 'epochs': 0}
+    with open(path) as fp:
+        for line in fp:
+            if not line.startswith(('Epoch', 'Step')) or ',valid_acc,' not in line:
+                continue
+            fields = line.strip().split(',')
+            values = dict(zip(fields[1::2], fields[2::2]))
+            valid_acc = float(values['valid_acc'].rstrip('%'))
+            if line.startswith('Epoch'):
+                best['epochs'] += 1
+            if best['best_valid_acc'] is None or valid_acc > best['best_valid_acc']:
+                best.update(best_valid_acc=valid_acc, best_valid_loss=float(values['valid_loss']),
+                            best_epoch=fields[0], train_acc=float(values['train_acc'].rstrip('%')))
+    return best
+
+
+def cpu_slots(n_workers, threads):
+    # disjoint core sets for the workers, `threads` cores each as far as the machine allows;
+    # callers keep n_workers <= cores, so the sets never overlap
+    cpus = available_cpus()
+    if n_workers > len(cpus):
+        raise ValueError('{} workers for {} cores'.format(n_workers, len(cpus)))
+    per_worker = max(min(threads, len(cpus) // n_workers), 1)
+    return [cpus[i * per_worker:(i + 1) * per_worker] for i in range(n_workers)]
+
+
+def launch(run, out_dir, args, slots):
+    # one train.py process; blocks until it exits
+    slot = slots.get()
+    try:
+        name = run_name(run)
+        log = os.path.join(out_dir, name + '.log')
+        checkpoint = os.path.join(out_dir, name + '.pt')
+        cmd = [sys.executable, args.script, '--rnn', run['rnn'], '--layers', str(run['layers']),
+               '--hidden-dim', str(run['hidden_dim']), '--lr', str(run['lr']), '--max-epoch', str(args.max_epoch),
+               '--time-budget', str(args.time_budget), '--checkpoint', checkpoint, '--device', slot['device'],
+               '--threads', str(slot['threads'])]
+        if slot['cpus']:
+            cmd += ['--cpus', slot['cpus']]
+        # caps the OpenMP / MKL pools too, before torch starts in the child
+        env = dict(os.environ, OMP_NUM_THREADS=str(slot['threads']), MKL_NUM_THREADS=str(slot['threads']))
+        start = time.time()
+        with open(log, 'w') as fp:
+            returncode = subprocess.call(cmd, stdout=fp, stderr=subprocess.STDOUT, env=env)
+        result = dict(run, seconds=round(time.time() - start, 1), returncode=returncode, log=log,
+                      checkpoint=checkpoint if os.path.exists(checkpoint) else '')
+        result.update(parse_log(log))
+        print('{} done in {:.0f}s, best valid_acc {}, exit code {}'.format(
+            name, result['seconds'], result['best_valid_acc'], returncode))
+        return result
+    finally:
+        slots.put(slot)
+
+
+def write_results(path, results):
+    results = sorted(results, key=lambda r: -1 if r['best_valid_acc'] is None else r['best_valid_acc'], reverse=True)
+    with open(path, 'w') as fp:
+        writer = csv.DictWriter(fp, FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Run a grid of train.py configurations in parallel')
+    parser.add_argument('--rnn', type=lambda s: s.split(','), default=['GRU', 'biGRU'])
+    parser.add_argument('--layers', type=lambda s: [int(x) for x in s.split(',')], default=[1])
+    parser.add_argument('--hidden-dim', type=lambda s: [int(x) for x in s.split(',')], default=[128])
+    parser.add_argument('--lr', type=lambda s: [float(x) for x in s.split(',')], default=[1e-4])
+    parser.add_argument('--workers', type=int, default=0, help='concurrent runs (0: cores / threads)')
+    parser.add_argument('--threads', type=int, default=4, help='intra-op threads per run')
+    parser.add_argument('--devices', type=lambda s: s.split(','), default=['cpu'],
+                        help="'cpu' or GPU indices, given to the workers round robin")
+    parser.add_argument('--max-epoch', type=int, default=30)
+    parser.add_argument('--time-budget', type=float, default=0, help='seconds per run (0: no limit)')
+    parser.add_argument('--out-dir', default='sweeps/' + time.strftime('%Y%m%d-%H%M%S'))
+    parser.add_argument('--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py'))
+    args = parser.parse_args(argv[1:])
+
+    runs = grid(args.rnn, args.layers, args.hidden_dim, args.lr)
+    workers = args.workers or max(len(available_cpus()) // args.threads, 1)
+    workers = min(workers, len(runs))
+    n_cpus = len(available_cpus())
+    if workers > n_cpus:
+        print('warning: {} workers for {} cores, running {} at a time'.format(workers, n_cpus, n_cpus))
+        workers = n_cpus
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    slots = queue.Queue()
+    slot_cpus = cpu_slots(workers, args.threads)
+    if len(slot_cpus[0]) < args.threads:
+        print('warning: {} threads per run do not fit {} workers on {} cores, using {}'.format(
+            args.threads, workers, n_cpus, len(slot_cpus[0])))
+    for i, cpus in enumerate(slot_cpus):
+        device = args.devices[i % len(args.devices)]
+        # GPU runs leave core placement to the OS
+        if device == 'cpu':
+            slots.put({'device': device, 'cpus': ','.join(str(c) for c in cpus), 'threads': len(cpus)})
+        else:
+            slots.put({'device': device, 'cpus': None, 'threads': args.threads})
+    print('{} runs on {} workers x {} threads, logs in {}'.format(len(runs), workers, len(slot_cpus[0]), args.out_dir))
+
+    with ThreadPoolExecutor(workers) as pool:
+        results = list(pool.map(lambda run: launch(run, args.out_dir, args, slots), runs))
+    results = write_results(os.path.join(args.out_dir, 'results.csv'), results)
+    print(','.join(FIELDS[:9]))
+    for r in results:
+        print(','.join(str(r[k]) for k in FIELDS[:9]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -4,6 +4,9 @@ import torch.nn.functional as F
 import torch.optim as optim
 from dataset import LandmarkList, LandmarkListTest
 from torch.utils import data
+from collate import PadCollate
+from device import setup_device
+from metrics import collect_scores, threshold_sweep, error_lists, roc_curve, equal_error_rate, write_curve
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import argparse
 
@@ -23,100 +26,48 @@ HIDDEN_DIM = 128
 N_LAYERS_RNN = 3
 LR = 1e-4
 DEVICES = 0
-torch.cuda.set_device(DEVICES)
+THREADS = 0
+INTEROP_THREADS = 0
+NUMA_NODE = None
+BATCH_SIZE = 256
+# write the full ROC / DET curves (threshold,fpr,tpr,fnr) of train and test to these files
+ROC_FILES = None  # e.g. ('roc_train.csv', 'roc_test.csv')
+device = setup_device(DEVICES, THREADS, INTEROP_THREADS, NUMA_NODE)
 
 
 def compute_binary_accuracy(model, data_loader, th_list):
-    len_th_list = len(th_list)
-    correct_pred, num_examples, FP, FN = [0.]*len_th_list, 0, [0]*len_th_list, [0]*len_th_list
-    FP_list = []
-    FN_list = []
-    for _ in range(len_th_list):
-        FP_list.append([])
-        FN_list.append([])
-    model.eval()
-    with torch.no_grad():
-        if rnn == 'frameGRU':
-            for batch, labels, lengths, f_names in data_loader:
-                logits = model(batch.cuda(), lengths)
-                out = torch.sigmoid(logits)
-                new_out_list = []
-                for i in range(len(lengths)):
-                    new_out_list.append(out[i][:lengths[i]].mean(0, keepdim=True))
-                # import pdb; pdb.set_trace()
-                out = torch.cat(new_out_list, 0)
-                num_examples += len(lengths)
-                for i, th in enumerate(th_list):
-                    predicted_labels = (out > th).long()
-                    if predicted_labels.squeeze(1).cpu().long() == torch.LongTensor(labels):
-                        correct_pred[i] += 1
-                    elif labels == 0:
-                        # print('FP: ', FP)
-                        FP[i] += 1
-                        FP_list[i].append(f_names[0] + '_' + str(labels.item()) + '_' + str(
-                            out.squeeze(1).cpu().item()))
-                    else:
-                        # print('FN: ', FN)
-                        FN[i] += 1
-                        FN_list[i].append(f_names[0] + '_' + str(labels.item()) + '_' + str(
-                            out.squeeze(1).cpu().item()))
-            return [n_correct/num_examples * 100 for n_correct in correct_pred], FP, FN, FP_list, FN_list
-        else:
-            for batch, labels, lengths, f_names in data_loader:
-                #import pdb; pdb.set_trace()
-                logits = model(batch.cuda(), lengths)
-                num_examples += len(lengths)
-                for i, th in enumerate(th_list):
-                    predicted_labels = (torch.sigmoid(logits) > th).long()
-                    if predicted_labels.squeeze(1).cpu().long() == torch.LongTensor(labels):
-                        correct_pred[i] += 1
-                    elif labels == 0:
-                        FP[i] += 1
-                        FP_list[i].append(f_names[0]+'_'+str(labels.item())+'_'+str(torch.sigmoid(logits).squeeze(1).cpu().item()))
-                    else:
-                        FN[i] += 1
-                        FN_list[i].append(f_names[0]+'_'+str(labels.item())+'_'+str(torch.sigmoid(logits).squeeze(1).cpu().item()))
-            return [n_correct/num_examples * 100 for n_correct in correct_pred], FP, FN, FP_list, FN_list
+    # one batched pass collects every score, then all thresholds are evaluated from the sorted scores
+    scores, labels, names = collect_scores(model, data_loader, device, framewise=rnn in FRAMEWISE)
+    acc, FP, FN = threshold_sweep(scores, labels, th_list)
+    FP_list, FN_list = error_lists(scores, labels, names, FP, FN)
+    return acc.tolist(), FP.tolist(), FN.tolist(), FP_list, FN_list, roc_curve(scores, labels)
 
 
-
-if rnn == 'frameGRU':
-    model = Framewise_GRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'sumGRU':
-    model = sumGRU(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'embedGRU':
-    model = embed_GRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-    model.load_state_dict(torch.load("models/" + str(rnn) + "_L" + str(N_LAYERS_RNN) + ".pt"))
-if rnn == 'GRU':
-    model = GRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-    model.load_state_dict(torch.load("models/" + str(rnn) + "_L" + str(N_LAYERS_RNN) + ".pt"))
-if rnn == 'biGRU':
-    model = biGRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-    model.load_state_dict(torch.load("models/" + str(rnn) + "_L" + str(N_LAYERS_RNN) + ".pt"))
-if rnn == 'LSTM':
-    model = LSTM_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'cnn':
-    model = cnn_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1)
-if rnn == 'crnn':
-    model = crnn_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-# model.load_state_dict(torch.load("models/"+str(rnn)+".pt"))
-model = model.cuda()
+model = build_model(rnn, EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
+model.load_state_dict(torch.load("models/" + str(rnn) + "_L" + str(N_LAYERS_RNN) + ".pt", map_location=device))
+model = model.to(device)
 
 loss_function = torch.nn.BCEWithLogitsLoss()
 loss_function_eval_sum = torch.nn.BCEWithLogitsLoss(reduction='sum')
 optimizer = optim.Adam(model.parameters(), lr=LR)
 
+# batches stay in dataset order so the FP / FN lists come out as with batch_size=1
+collate_fn = PadCollate(packed=rnn in PACKED, sort=False)
 dataset_train = LandmarkListTest(root='/datasets/move_closer/Data_Distortion/', fileList='/datasets/move_closer/TrainList.txt')
-dataloader_train = data.DataLoader(dataset_train, batch_size=1, shuffle=False, num_workers=0)
+dataloader_train = data.DataLoader(dataset_train, batch_size=BATCH_SIZE, shuffle=False, num_workers=0, collate_fn=collate_fn)
 
 dataset_test = LandmarkListTest(root='/datasets/move_closer/Data_Distortion/', fileList='/datasets/move_closer/TestList.txt')
-dataloader_test = data.DataLoader(dataset_test, batch_size=1, shuffle=False, num_workers=0)
+dataloader_test = data.DataLoader(dataset_test, batch_size=BATCH_SIZE, shuffle=False, num_workers=0, collate_fn=collate_fn)
 
 # thresholds = [x * 0.01 for x in range(30, 71)]
 thresholds = [0.5]
 
-train_acc, train_fp, train_fn, train_fp_list, train_fn_list = compute_binary_accuracy(model, dataloader_train, thresholds)
-test_acc, test_fp, test_fn, test_fp_list, test_fn_list = compute_binary_accuracy(model, dataloader_test, thresholds)
+train_acc, train_fp, train_fn, train_fp_list, train_fn_list, train_roc = compute_binary_accuracy(model, dataloader_train, thresholds)
+test_acc, test_fp, test_fn, test_fp_list, test_fn_list, test_roc = compute_binary_accuracy(model, dataloader_test, thresholds)
+print('train_eer,{:.2f}%,valid_eer,{:.2f}%'.format(equal_error_rate(*train_roc[1:]), equal_error_rate(*test_roc[1:])))
+if ROC_FILES is not None:
+    write_curve(ROC_FILES[0], *train_roc)
+    write_curve(ROC_FILES[1], *test_roc)
 
 for i in range(0, len(thresholds)):
     print('\n\n-----------------Eval for threshold of {:.2f}-------------------\n\n'.format(thresholds[i]))
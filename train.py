@@ -2,15 +2,23 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from dataset import LandmarkList
+from dataset import LandmarkList, LandmarkStream, PackedLandmarkList
+from features import PairwiseDistanceCollate
+from prefetch import Prefetcher
+from sampler import BucketBatchSampler, dataset_lengths, padding_efficiency
 from torch.utils import data
+from collate import PadCollate
+from device import setup_device
+from precision import autocast, backward, grad_scaler, step
+from controller import TrainController
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import argparse
+import time
 
 from model import *
 
 # rnn = 'frameGRU'
-# to be implemented - rnn = 'frameCRNN'
+# rnn = 'frameCRNN'
 rnn = 'sumGRU'
 # rnn = 'crnn'
 # rnn = 'cnn'
@@ -24,121 +32,207 @@ N_LAYERS_RNN = 1
 MAX_EPOCH = 30000
 LR = 1e-4
 DEVICES = 3
+# GPU index or 'cpu'; THREADS / INTEROP_THREADS (0: defaults) and NUMA_NODE (pin to that node's
+# cores) set up CPU parallelism, see device.setup_device
+THREADS = 0
+INTEROP_THREADS = 0
+NUMA_NODE = None
 SAVE_BEST_MODEL = True
-torch.cuda.set_device(DEVICES)
+# read the raw 68x2 Data_Landmark files and compute the 2278 pairwise distances per batch
+# instead of reading the precomputed Data_Distortion files
+ON_THE_FLY_DISTANCE = False
+DATA_ROOT = '/datasets/move_closer/Data_Landmark/' if ON_THE_FLY_DISTANCE else '/datasets/move_closer/Data_Distortion/'
+# group training sequences of similar length into a batch to cut padded frames;
+# with MAX_FRAMES_PER_BATCH set, batch size adapts so batch x longest stays under it
+BUCKET_BATCHES = False
+MAX_FRAMES_PER_BATCH = None
+# shared-memory LRU budget (bytes) for decoded training / test sequences, 0 disables it
+CACHE_BYTES_TRAIN = 0
+CACHE_BYTES_TEST = 0
+# manifest.py index with per-file lengths (lets bucketing skip a full read of the training set)
+MANIFEST_TRAIN = None  # e.g. '/datasets/move_closer/TrainList.manifest.npz'
+# packed shards from pack_dataset.py avoid one open + unpickle per sample per epoch; set to read them instead of the lists
+PACKED_TRAIN = None  # e.g. '/datasets/move_closer/Packed/Distortion_Train/'
+PACKED_TEST = None  # e.g. '/datasets/move_closer/Packed/Distortion_Test/'
+# stream the training list sequentially instead of indexing it (approximate shuffle, bounded buffer)
+STREAM_TRAIN = False
+SHUFFLE_BUFFER = 4096
+PREFETCH_BATCHES = 2
+# train_acc/train_loss come from the logits of the training pass itself (train mode, weights still moving);
+# an extra eval-mode pass over the training data runs every TRAIN_EVAL_EVERY epochs (0 disables it),
+# on a fixed random subsample of TRAIN_EVAL_SUBSET sequences if set, else on the whole list
+TRAIN_EVAL_EVERY = 0
+TRAIN_EVAL_SUBSET = 0
+# validate every EVAL_EVERY_EPOCHS epochs and/or every EVAL_EVERY_STEPS optimizer steps (0 disables either);
+# stop after PATIENCE validations without a better MONITOR ('valid_acc' or 'valid_loss') or after
+# TIME_BUDGET seconds (0 disables both). The best validation by MONITOR is saved to models/<rnn>_L<n>.pt
+EVAL_EVERY_EPOCHS = 1
+EVAL_EVERY_STEPS = 0
+PATIENCE = 0
+MONITOR = 'valid_acc'
+TIME_BUDGET = 0
+# 'float32', or autocast in 'bfloat16' (CPU / GPU) or 'float16' (GPU, with loss scaling), see precision.py
+PRECISION = 'float32'
+# command-line overrides of the settings above (sweep.py starts its runs this way); none by default
+parser = argparse.ArgumentParser(description='Train one classifier from model.py')
+parser.add_argument('--rnn', default=rnn, choices=list(MODELS))
+parser.add_argument('--layers', type=int, default=N_LAYERS_RNN)
+parser.add_argument('--hidden-dim', type=int, default=HIDDEN_DIM)
+parser.add_argument('--lr', type=float, default=LR)
+parser.add_argument('--max-epoch', type=int, default=MAX_EPOCH)
+parser.add_argument('--time-budget', type=float, default=TIME_BUDGET)
+parser.add_argument('--device', default=DEVICES, help="GPU index or 'cpu'")
+parser.add_argument('--threads', type=int, default=THREADS)
+parser.add_argument('--cpus', default=None, help="pin the process to these cores, e.g. '0-7'")
+parser.add_argument('--checkpoint', default=None, help='best model file (default models/<rnn>_L<layers>.pt)')
+if __name__ == '__main__':
+    args = parser.parse_args()
+else:
+    # imported from another tool: the constants above, not the importer's argv
+    args = parser.parse_args([])
+rnn, N_LAYERS_RNN, HIDDEN_DIM, LR = args.rnn, args.layers, args.hidden_dim, args.lr
+MAX_EPOCH, TIME_BUDGET, THREADS = args.max_epoch, args.time_budget, args.threads
+DEVICES = int(args.device) if str(args.device).isdigit() else args.device
+CHECKPOINT = args.checkpoint or 'models/' + rnn + '_L' + str(N_LAYERS_RNN) + '.pt'
+device = setup_device(DEVICES, THREADS, INTEROP_THREADS, NUMA_NODE, args.cpus)
 
 
-def compute_binary_accuracy(model, data_loader, loss_function):
+def compute_binary_accuracy(model, data_loader):
     correct_pred, num_examples, total_loss = 0, 0, 0.
     model.eval()
     with torch.no_grad():
-        if rnn == 'frameGRU' or rnn == 'frameCRNN':
-            for batch, labels, lengths in data_loader:
-                logits = model(batch.cuda(), lengths)
-                out = torch.sigmoid(logits)
-                # if rnn == 'frameGRU':
-                #     new_out_list = []
-                #     new_labels_list = []
-                #     for i in range(len(lengths)):
-                #         new_out_list.append(out[i][:lengths[i]].sum())
-                #     out = torch.cat(new_out_list, 0)
-                new_labels_list = []
-                new_logits_list = []
-                new_out_list = []
-                for i in range(len(lengths)):
-                    new_labels_list += [labels[i]] * lengths[i]
-                    new_logits_list.append(out[i][:lengths[i]])
-                    new_out_list.append(out[i][:lengths[i]].mean(0, keepdim=True))
-                # import pdb; pdb.set_trace()
-                logits_framewise = torch.cat(new_logits_list, 0)
-                labels_framewise = new_labels_list
-                out = torch.cat(new_out_list, 0)
-                total_loss += loss_function(logits_framewise, torch.FloatTensor(labels_framewise).unsqueeze(1).cuda()).item()
-                predicted_labels = (out > 0.5).long()
-                num_examples += len(lengths)
-                correct_pred += (predicted_labels.squeeze(1).cpu().long() == torch.LongTensor(labels)).sum()
-            return correct_pred.float().item()/num_examples * 100, total_loss
-        else:
-            for batch, labels, lengths in data_loader:
-                logits = model(batch.cuda(), lengths)
-                total_loss += loss_function(logits, torch.FloatTensor(labels).unsqueeze(1).cuda()).item()
-                predicted_labels = (torch.sigmoid(logits) > 0.5).long()
-                num_examples += len(lengths)
-                correct_pred += (predicted_labels.squeeze(1).cpu().long() == torch.LongTensor(labels)).sum()
-            return correct_pred.float().item()/num_examples * 100, total_loss
-
-
-def pad_collate(batch):
-    batch.sort(key=lambda x: x[2], reverse=True)
-    lms, tgs, lens = zip(*batch)
-    new_lms = torch.zeros((len(lms), lms[0].shape[0], lms[0].shape[1])) # batch x seq x feature(136)
-    new_lms[0] = lms[0]
-    for i in range(1, len(lms)):
-        new_lms[i] = torch.cat((lms[i], torch.zeros((lens[0] - lens[i]),EMBEDDING_DIM)), 0)
-    return new_lms, tgs, lens
-
-if rnn == 'frameGRU':
-    model = Framewise_GRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'frameCRNN':
-    model = FrameCRNN(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'sumGRU':
-    model = sumGRU(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'embedGRU':
-    model = embed_GRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'GRU':
-    model = GRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'biGRU':
-    model = biGRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'LSTM':
-    model = LSTM_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'cnn':
-    model = cnn_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1)
-if rnn == 'crnn':
-    model = crnn_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-model = model.cuda()
-
-loss_function = torch.nn.BCEWithLogitsLoss()
-loss_function_eval_sum = torch.nn.BCEWithLogitsLoss(reduction='sum')
+        for batch, labels, lengths in data_loader:
+            with autocast(device, PRECISION):
+                logits = model(batch, lengths).float()
+            loss, scores, _ = batch_loss(model, logits, labels, lengths, rnn in FRAMEWISE, reduction='sum')
+            total_loss += loss.item()
+            correct_pred += count_correct(scores, labels).item()
+            num_examples += len(lengths)
+    return correct_pred/num_examples * 100, total_loss
+
+
+# the recurrent models take a ready-made PackedSequence, the conv models need the padded batch
+collate_fn = PadCollate(packed=rnn in PACKED)
+if ON_THE_FLY_DISTANCE:
+    collate_fn = PairwiseDistanceCollate(collate_fn)
+
+model = build_model(rnn, EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
+model = model.to(device)
+
 optimizer = optim.Adam(model.parameters(), lr=LR)
+scaler = grad_scaler(device, PRECISION)
 
-dataset_train = LandmarkList(root='/datasets/move_closer/Data_Distortion/', fileList='/datasets/move_closer/TrainList.txt')
-dataloader_train = data.DataLoader(dataset_train, batch_size=128, shuffle=True, num_workers=0, collate_fn=pad_collate)
+if STREAM_TRAIN:
+    dataset_train = LandmarkStream(root=DATA_ROOT, fileList='/datasets/move_closer/TrainList.txt', shuffle_buffer=SHUFFLE_BUFFER)
+elif PACKED_TRAIN:
+    dataset_train = PackedLandmarkList(root=PACKED_TRAIN)
+else:
+    dataset_train = LandmarkList(root=DATA_ROOT, fileList='/datasets/move_closer/TrainList.txt', cache_bytes=CACHE_BYTES_TRAIN,
+                                 manifest=MANIFEST_TRAIN)
+if STREAM_TRAIN:
+    dataloader_train = data.DataLoader(dataset_train, batch_size=128, num_workers=0, collate_fn=collate_fn)
+elif BUCKET_BATCHES:
+    batch_sampler_train = BucketBatchSampler(dataset_lengths(dataset_train), batch_size=128, max_frames=MAX_FRAMES_PER_BATCH)
+    dataloader_train = data.DataLoader(dataset_train, batch_sampler=batch_sampler_train, num_workers=0, collate_fn=collate_fn)
+else:
+    dataloader_train = data.DataLoader(dataset_train, batch_size=128, shuffle=True, num_workers=0, collate_fn=collate_fn)
 # if rnn == 'frameGRU':
 #     dataloader_train = data.DataLoader(dataset_train, batch_size=8, shuffle=True, num_workers=2,
 #                                        collate_fn=pad_collate)
 
-dataset_test = LandmarkList(root='/datasets/move_closer/Data_Distortion/', fileList='/datasets/move_closer/TestList.txt')
-dataloader_test = data.DataLoader(dataset_test, batch_size=64, shuffle=False, num_workers=0, collate_fn=pad_collate)
+if PACKED_TEST:
+    dataset_test = PackedLandmarkList(root=PACKED_TEST)
+else:
+    dataset_test = LandmarkList(root=DATA_ROOT, fileList='/datasets/move_closer/TestList.txt', cache_bytes=CACHE_BYTES_TEST)
+dataloader_test = data.DataLoader(dataset_test, batch_size=64, shuffle=False, num_workers=0, collate_fn=collate_fn)
+
+# next PREFETCH_BATCHES batches are loaded, pinned and copied to the GPU in the background
+prefetch_train = Prefetcher(dataloader_train, device, depth=PREFETCH_BATCHES)
+prefetch_test = Prefetcher(dataloader_test, device, depth=PREFETCH_BATCHES)
+
+if TRAIN_EVAL_EVERY:
+    if STREAM_TRAIN:
+        dataset_train_eval = LandmarkList(root=DATA_ROOT, fileList='/datasets/move_closer/TrainList.txt')
+    else:
+        dataset_train_eval = dataset_train
+    if TRAIN_EVAL_SUBSET and TRAIN_EVAL_SUBSET < len(dataset_train_eval):
+        subset = torch.randperm(len(dataset_train_eval), generator=torch.Generator().manual_seed(0))[:TRAIN_EVAL_SUBSET]
+        dataset_train_eval = data.Subset(dataset_train_eval, subset.sort()[0].tolist())
+    dataloader_train_eval = data.DataLoader(dataset_train_eval, batch_size=64, shuffle=False, num_workers=0, collate_fn=collate_fn)
+    prefetch_train_eval = Prefetcher(dataloader_train_eval, device, depth=PREFETCH_BATCHES)
+
+def running_metrics():
+    # [correct, summed loss, sequences] since the last validation, kept on the device so steps do not sync
+    return [torch.zeros((), dtype=torch.long, device=device),
+            torch.zeros((), device=device), 0]
 
-best_test_acc = 0.
+
+def validate(epoch, running, mid_epoch=False):
+    # train metrics come from the training steps since the last validation
+    train_acc, train_loss = running[0].item() / max(running[2], 1) * 100, running[1].item()
+    test_acc, test_loss = compute_binary_accuracy(model, prefetch_test)
+    # plot_log.py reads the Epoch lines; validations inside an epoch are logged by step
+    tag = 'Step{}'.format(controller.step) if mid_epoch else 'Epoch{}'.format(epoch)
+    print('{},train_acc,{:.2f}%,train_loss,{:.8f},valid_acc,{:.2f}%,valid_loss,{:.8f}'.format(tag, train_acc, train_loss, test_acc, test_loss))
+    if controller.update(test_acc, test_loss):
+        if SAVE_BEST_MODEL:
+            torch.save(model.state_dict(), CHECKPOINT)
+        print('best epoch {}, step {}, train_acc {}, test_acc {}'.format(epoch, controller.step, train_acc, test_acc))
+    model.train()
+    return running_metrics()
+
+
+controller = TrainController(eval_every_epochs=EVAL_EVERY_EPOCHS, eval_every_steps=EVAL_EVERY_STEPS, patience=PATIENCE,
+                             monitor=MONITOR, time_budget=TIME_BUDGET)
+running = running_metrics()
 for epoch in range(MAX_EPOCH):
     model.train()
+    if STREAM_TRAIN:
+        dataset_train.set_epoch(epoch)
+    elif BUCKET_BATCHES:
+        batch_sampler_train.set_epoch(epoch)
     n_iter = 0
-    for batch, labels, lengths in dataloader_train:
+    n_frames, n_padded_frames = 0, 0
+    epoch_start = time.time()
+    for batch, labels, lengths in prefetch_train:
+        real, padded = padding_efficiency(lengths)
+        n_frames += real
+        n_padded_frames += padded
         model.zero_grad()
-        out = model(batch.cuda(), lengths)  # we could do a classifcation for every output (probably better)
-        if rnn == 'frameGRU':
-            new_labels_list = []
-            new_out_list = []
-            for i in range(len(lengths)):
-                new_labels_list += [labels[i]] * lengths[i]
-                new_out_list.append(out[i][:lengths[i]])
-            out = torch.cat(new_out_list, 0)
-            labels = new_labels_list
-        loss = loss_function(out, torch.FloatTensor(labels).unsqueeze(1).cuda())
-        loss.backward()
-        optimizer.step()
+        with autocast(device, PRECISION):
+            out = model(batch, lengths).float()  # we could do a classifcation for every output (probably better)
+        loss, prob, n_out = batch_loss(model, out, labels, lengths, rnn in FRAMEWISE)
+        backward(model, loss, scaler)
+        step(optimizer, scaler)
+        with torch.no_grad():
+            # batch_loss averages, compute_binary_accuracy reports the sum
+            running[1] += loss.detach() * n_out
+            running[0] += count_correct(prob, labels)
+        running[2] += len(lengths)
         n_iter += 1
-    train_acc, train_loss = compute_binary_accuracy(model, dataloader_train, loss_function_eval_sum)
-    test_acc, test_loss = compute_binary_accuracy(model, dataloader_test, loss_function_eval_sum)
-    print('Epoch{},train_acc,{:.2f}%,train_loss,{:.8f},valid_acc,{:.2f}%,valid_loss,{:.8f}'.format(epoch, train_acc, train_loss, test_acc, test_loss))
-    if test_acc > best_test_acc:
-        best_test_acc = test_acc
-        if SAVE_BEST_MODEL:
-            torch.save(model.state_dict(), 'models/' + rnn +
-                       '_L' + str(N_LAYERS_RNN) + '.pt')
-        print('best epoch {}, train_acc {}, test_acc {}'.format(epoch, train_acc, test_acc))
-
+        if controller.after_step():
+            running = validate(epoch, running, mid_epoch=True)
+        if controller.stopped:
+            break
+    print('padding efficiency {:.2f}% ({} of {} frames)'.format(100. * n_frames / max(n_padded_frames, 1), n_frames, n_padded_frames))
+    print('train ' + prefetch_train.report(time.time() - epoch_start))
+    if controller.stopped:
+        break
+    if TRAIN_EVAL_EVERY and (epoch + 1) % TRAIN_EVAL_EVERY == 0:
+        eval_acc, eval_loss = compute_binary_accuracy(model, prefetch_train_eval)
+        print('train_eval,{} sequences,acc,{:.2f}%,loss,{:.8f}'.format(len(dataset_train_eval), eval_acc, eval_loss))
+        model.train()
+    if controller.after_epoch():
+        running = validate(epoch, running)
+    for name, dataset in (('train', dataset_train), ('test', dataset_test)):
+        if getattr(dataset, 'cache', None) is not None:
+            print('{} {}'.format(name, dataset.cache.report()))
+    if controller.stopped:
+        break
+# a run cut short by the time budget (or ending between validations) still gets its last weights validated
+if controller.pending_eval():
+    running = validate(epoch, running)
+print(controller.report())
 
 
 
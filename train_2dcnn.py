@@ -4,6 +4,8 @@ import torch.nn.functional as F
 import torch.optim as optim
 from dataset import LandmarkList
 from torch.utils import data
+from collate import pad_collate
+from device import setup_device
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import argparse
 
@@ -12,7 +14,7 @@ from model import *
 
 rnn = '2dcnn'
 # rnn = 'frameGRU'
-# to be implemented - rnn = 'frameCRNN'
+# rnn = 'frameCRNN'
 # rnn = 'sumGRU'
 # rnn = 'crnn'
 # rnn = 'cnn'
@@ -26,80 +28,39 @@ N_LAYERS_RNN = 3
 MAX_EPOCH = 1000
 LR = 1e-4
 DEVICES = 2
+THREADS = 0
+INTEROP_THREADS = 0
+NUMA_NODE = None
 SAVE_BEST_MODEL = True
-torch.cuda.set_device(DEVICES)
+device = setup_device(DEVICES, THREADS, INTEROP_THREADS, NUMA_NODE)
 
 
 def compute_binary_accuracy(model, data_loader, loss_function):
     correct_pred, num_examples, total_loss = 0, 0, 0.
     model.eval()
     with torch.no_grad():
-        if rnn == 'frameGRU' or rnn == 'frameCRNN':
+        if rnn in FRAMEWISE:
             for batch, labels, lengths in data_loader:
-                logits = model(batch.cuda(), lengths)
-                out = torch.sigmoid(logits)
-                # if rnn == 'frameGRU':
-                #     new_out_list = []
-                #     new_labels_list = []
-                #     for i in range(len(lengths)):
-                #         new_out_list.append(out[i][:lengths[i]].sum())
-                #     out = torch.cat(new_out_list, 0)
-                new_labels_list = []
-                new_logits_list = []
-                new_out_list = []
-                for i in range(len(lengths)):
-                    new_labels_list += [labels[i]] * lengths[i]
-                    new_logits_list.append(out[i][:lengths[i]])
-                    new_out_list.append(out[i][:lengths[i]].mean(0, keepdim=True))
-                # import pdb; pdb.set_trace()
-                logits_framewise = torch.cat(new_logits_list, 0)
-                labels_framewise = new_labels_list
-                out = torch.cat(new_out_list, 0)
-                total_loss += loss_function(logits_framewise, torch.FloatTensor(labels_framewise).unsqueeze(1).cuda()).item()
-                predicted_labels = (out > 0.5).long()
+                logits = model(batch.to(device), lengths)
+                frame_lengths = output_lengths(model, lengths)
+                total_loss += framewise_loss(logits, labels, frame_lengths, reduction='sum').item()
+                predicted_labels = (framewise_scores(logits, frame_lengths) > 0.5).long()
                 num_examples += len(lengths)
-                correct_pred += (predicted_labels.squeeze(1).cpu().long() == torch.LongTensor(labels)).sum()
+                correct_pred += (predicted_labels.cpu() == torch.LongTensor(labels)).sum()
             return correct_pred.float().item()/num_examples * 100, total_loss
         else:
             for batch, labels, lengths in data_loader:
-                logits = model(batch.cuda(), lengths)
-                total_loss += loss_function(logits, torch.FloatTensor(labels).unsqueeze(1).cuda()).item()
+                logits = model(batch.to(device), lengths)
+                total_loss += loss_function(logits, torch.FloatTensor(labels).unsqueeze(1).to(device)).item()
                 predicted_labels = (torch.sigmoid(logits) > 0.5).long()
                 num_examples += len(lengths)
                 correct_pred += (predicted_labels.squeeze(1).cpu().long() == torch.LongTensor(labels)).sum()
             return correct_pred.float().item()/num_examples * 100, total_loss
 
 
-def pad_collate(batch):
-    batch.sort(key=lambda x: x[2], reverse=True)
-    lms, tgs, lens = zip(*batch)
-    new_lms = torch.zeros((len(lms), lms[0].shape[0], lms[0].shape[1])) # batch x seq x feature(136)
-    new_lms[0] = lms[0]
-    for i in range(1, len(lms)):
-        new_lms[i] = torch.cat((lms[i], torch.zeros((lens[0] - lens[i]),EMBEDDING_DIM)), 0)
-    return new_lms, tgs, lens
-
-if rnn == '2dcnn':
-    model = cnn_2d(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'frameGRU':
-    model = Framewise_GRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'frameCRNN':
-    model = FrameCRNN(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'sumGRU':
-    model = sumGRU(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'embedGRU':
-    model = embed_GRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'GRU':
-    model = GRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'biGRU':
-    model = biGRU_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'LSTM':
-    model = LSTM_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-if rnn == 'cnn':
-    model = cnn_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1)
-if rnn == 'crnn':
-    model = crnn_Classifier(EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
-model = model.cuda()
+
+model = build_model(rnn, EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN)
+model = model.to(device)
 
 loss_function = torch.nn.BCEWithLogitsLoss()
 loss_function_eval_sum = torch.nn.BCEWithLogitsLoss(reduction='sum')
@@ -120,16 +81,11 @@ for epoch in range(MAX_EPOCH):
     n_iter = 0
     for batch, labels, lengths in dataloader_train:
         model.zero_grad()
-        out = model(batch.cuda(), lengths)  # we could do a classifcation for every output (probably better)
-        if rnn == 'frameGRU':
-            new_labels_list = []
-            new_out_list = []
-            for i in range(len(lengths)):
-                new_labels_list += [labels[i]] * lengths[i]
-                new_out_list.append(out[i][:lengths[i]])
-            out = torch.cat(new_out_list, 0)
-            labels = new_labels_list
-        loss = loss_function(out, torch.FloatTensor(labels).unsqueeze(1).cuda())
+        out = model(batch.to(device), lengths)  # we could do a classifcation for every output (probably better)
+        if rnn in FRAMEWISE:
+            loss = framewise_loss(out, labels, output_lengths(model, lengths))
+        else:
+            loss = loss_function(out, torch.FloatTensor(labels).unsqueeze(1).to(device))
         loss.backward()
         optimizer.step()
         n_iter += 1
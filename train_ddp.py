@@ -0,0 +1,141 @@
+import argparse
+import os
+import sys
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils import data
+
+from collate import PadCollate
+from controller import TrainController
+from dataset import LandmarkList
+from device import available_cpus, setup_device
+from model import FRAMEWISE, PACKED, batch_loss, build_model, count_correct
+from prefetch import Prefetcher
+
+
+rnn = 'biGRU'
+EMBEDDING_DIM = int(68 * 67 /2)
+HIDDEN_DIM = 128
+N_LAYERS_RNN = 1
+MAX_EPOCH = 30000
+LR = 1e-4
+# per process; the global batch is BATCH_SIZE x world size
+BATCH_SIZE = 128
+SAVE_BEST_MODEL = True
+PATIENCE = 0
+DATA_ROOT = '/datasets/move_closer/Data_Distortion/'
+TRAIN_LIST = '/datasets/move_closer/TrainList.txt'
+TEST_LIST = '/datasets/move_closer/TestList.txt'
+PREFETCH_BATCHES = 2
+
+
+def all_reduce(device, *values):
+    # sums over all processes --> list of floats; the tensor lives on `device` (nccl only reduces GPU tensors)
+    t = torch.tensor([float(v) for v in values], dtype=torch.float64, device=device)
+    dist.all_reduce(t)
+    return t.tolist()
+
+
+def compute_binary_accuracy(model, data_loader, device):
+    # this process' share of the list, summed over all processes
+    correct_pred, num_examples, total_loss = 0, 0, 0.
+    model.eval()
+    with torch.no_grad():
+        for batch, labels, lengths in data_loader:
+            logits = model(batch, lengths)
+            loss, scores, _ = batch_loss(model, logits, labels, lengths, rnn in FRAMEWISE, reduction='sum')
+            total_loss += loss.item()
+            correct_pred += count_correct(scores, labels).item()
+            num_examples += len(lengths)
+    correct_pred, num_examples, total_loss = all_reduce(device, correct_pred, num_examples, total_loss)
+    return correct_pred / max(num_examples, 1) * 100, total_loss
+
+
+def run(rank, world_size, args):
+    # one training process: the model is replicated by DistributedDataParallel, which averages the
+    # gradients over all processes in backward; each process trains on its DistributedSampler shard
+    dist.init_process_group(args.backend, rank=rank, world_size=world_size)
+    # torchrun sets LOCAL_RANK / LOCAL_WORLD_SIZE per node; mp.spawn runs everything on this host
+    local_rank = int(os.environ.get('LOCAL_RANK', rank))
+    local_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    threads = args.threads or max(len(available_cpus()) // local_size, 1)
+    device = setup_device('cuda:%d' % local_rank if args.backend == 'nccl' else 'cpu', threads, verbose=rank == 0)
+    torch.manual_seed(args.seed)  # identical initial weights on every process
+
+    collate_fn = PadCollate(packed=rnn in PACKED)
+    model = build_model(rnn, EMBEDDING_DIM, HIDDEN_DIM, 1, n_layer=N_LAYERS_RNN).to(device)
+    ddp_model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+    optimizer = optim.Adam(ddp_model.parameters(), lr=LR)
+
+    dataset_train = LandmarkList(root=DATA_ROOT, fileList=TRAIN_LIST)
+    # drops the tail of the shuffled list to make the shards equal (every process runs the same number
+    # of steps) instead of padding them with duplicates, which would count twice in the train metrics
+    sampler_train = data.distributed.DistributedSampler(dataset_train, world_size, rank, shuffle=True, seed=args.seed,
+                                                        drop_last=True)
+    dataloader_train = data.DataLoader(dataset_train, batch_size=BATCH_SIZE, sampler=sampler_train, num_workers=0,
+                                       collate_fn=collate_fn)
+    # test shards without padding: every sequence counts exactly once in the reduced metrics
+    dataset_test = LandmarkList(root=DATA_ROOT, fileList=TEST_LIST)
+    dataset_test = data.Subset(dataset_test, range(rank, len(dataset_test), world_size))
+    dataloader_test = data.DataLoader(dataset_test, batch_size=64, shuffle=False, num_workers=0, collate_fn=collate_fn)
+    prefetch_train = Prefetcher(dataloader_train, device, depth=PREFETCH_BATCHES)
+    prefetch_test = Prefetcher(dataloader_test, device, depth=PREFETCH_BATCHES)
+
+    # the reduced metrics are the same on every process, so are the controller's decisions
+    controller = TrainController(patience=PATIENCE)
+    for epoch in range(args.epochs):
+        sampler_train.set_epoch(epoch)
+        ddp_model.train()
+        correct, loss_sum, n = 0, 0., 0
+        for batch, labels, lengths in prefetch_train:
+            optimizer.zero_grad()
+            out = ddp_model(batch, lengths)
+            loss, scores, n_out = batch_loss(model, out, labels, lengths, rnn in FRAMEWISE)
+            loss.backward()
+            optimizer.step()
+            controller.after_step()
+            loss_sum += loss.item() * float(n_out)
+            correct += count_correct(scores, labels).item()
+            n += len(lengths)
+        correct, n, loss_sum = all_reduce(device, correct, n, loss_sum)
+        train_acc, train_loss = correct / max(n, 1) * 100, loss_sum
+        controller.after_epoch()
+        test_acc, test_loss = compute_binary_accuracy(model, prefetch_test, device)
+        if rank == 0:
+            print('Epoch{},train_acc,{:.2f}%,train_loss,{:.8f},valid_acc,{:.2f}%,valid_loss,{:.8f}'.format(
+                epoch, train_acc, train_loss, test_acc, test_loss))
+        if controller.update(test_acc, test_loss) and rank == 0:
+            if SAVE_BEST_MODEL:
+                torch.save(model.state_dict(), 'models/' + rnn + '_L' + str(N_LAYERS_RNN) + '.pt')
+            print('best epoch {}, train_acc {}, test_acc {}'.format(epoch, train_acc, test_acc))
+        if controller.stopped:
+            break
+    if rank == 0:
+        print(controller.report())
+    dist.destroy_process_group()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Data-parallel training over several processes')
+    parser.add_argument('--nprocs', type=int, default=2, help='processes to spawn (ignored under torchrun)')
+    parser.add_argument('--backend', default='gloo', choices=['gloo', 'nccl'], help='nccl: one GPU per process')
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads per process (0: cores / processes)')
+    parser.add_argument('--epochs', type=int, default=MAX_EPOCH)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv[1:])
+
+    if 'RANK' in os.environ:
+        # started by torchrun, which also sets MASTER_ADDR / MASTER_PORT
+        run(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), args)
+    else:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', '29500')
+        mp.spawn(run, args=(args.nprocs, args), nprocs=args.nprocs)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,167 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.optim as optim
+from torch.utils import data
+
+from collate import PadCollate
+from controller import TrainController
+from dataset import LandmarkList
+from device import setup_device
+from model import FRAMEWISE, MODELS, batch_loss, build_model, count_correct
+from prefetch import Prefetcher
+
+
+RNNS = ('GRU', 'biGRU', 'LSTM', 'crnn')
+EMBEDDING_DIM = int(68 * 67 /2)
+HIDDEN_DIM = 128
+N_LAYERS_RNN = 1
+MAX_EPOCH = 30000
+LR = 1e-4
+DEVICES = 3
+THREADS = 0
+BATCH_SIZE = 128
+SAVE_BEST_MODEL = True
+PATIENCE = 0
+DATA_ROOT = '/datasets/move_closer/Data_Distortion/'
+TRAIN_LIST = '/datasets/move_closer/TrainList.txt'
+TEST_LIST = '/datasets/move_closer/TestList.txt'
+PREFETCH_BATCHES = 2
+LOG_DIR = 'logs/'
+
+
+def member_names(rnns, n_layer):
+    # <rnn>_L<n> for logs and checkpoints; a repeated rnn gets _2, _3, ... so no two share a file
+    names, seen = [], {}
+    for rnn in rnns:
+        seen[rnn] = seen.get(rnn, 0) + 1
+        names.append(rnn + '_L' + str(n_layer) + ('_' + str(seen[rnn]) if seen[rnn] > 1 else ''))
+    return names
+
+
+class Member(object):
+    # one model of the shared run with its own optimizer, early stopping, log file and checkpoint
+    def __init__(self, rnn, device, hidden_dim, n_layer, lr, log_dir, name):
+        self.rnn = rnn
+        self.device = device
+        self.framewise = rnn in FRAMEWISE
+        self.model = build_model(rnn, EMBEDDING_DIM, hidden_dim, 1, n_layer=n_layer).to(device)
+        self.optimizer = optim.Adam(self.model.parameters(), lr=lr)
+        self.controller = TrainController(patience=PATIENCE)
+        self.name = name
+        self.checkpoint = 'models/' + self.name + '.pt'
+        self.log = open(os.path.join(log_dir, self.name + '.txt'), 'a')
+        self.seconds = 0.
+        self.reset()
+
+    def reset(self):
+        # [correct, summed loss, sequences] since the last validation, as train.running_metrics
+        self.running = [torch.zeros((), dtype=torch.long, device=self.device), torch.zeros((), device=self.device), 0]
+
+    def synchronize(self):
+        # CUDA kernels run asynchronously; wait for them so seconds counts compute, not launches
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def train_step(self, batch, labels, lengths):
+        self.synchronize()
+        start = time.time()
+        self.model.zero_grad()
+        out = self.model(batch, lengths)
+        loss, scores, n_out = batch_loss(self.model, out, labels, lengths, self.framewise)
+        loss.backward()
+        self.optimizer.step()
+        with torch.no_grad():
+            self.running[1] += loss.detach() * n_out
+            self.running[0] += count_correct(scores, labels)
+        self.running[2] += len(lengths)
+        self.controller.after_step()
+        self.synchronize()
+        self.seconds += time.time() - start
+
+    def print(self, line):
+        # the per-model log keeps the format of train.py's output (plot_log.py)
+        print('{} {}'.format(self.name, line))
+        self.log.write(line + '\n')
+        self.log.flush()
+
+
+def validate(members, data_loader, epoch):
+    # one pass over the test list scores every model still training
+    for m in members:
+        m.model.eval()
+        m.eval_sums = [0, 0.]
+    num_examples = 0
+    with torch.no_grad():
+        for batch, labels, lengths in data_loader:
+            for m in members:
+                out = m.model(batch, lengths)
+                loss, scores, _ = batch_loss(m.model, out, labels, lengths, m.framewise, reduction='sum')
+                m.eval_sums[0] += count_correct(scores, labels).item()
+                m.eval_sums[1] += loss.item()
+            num_examples += len(lengths)
+    for m in members:
+        train_acc, train_loss = m.running[0].item() / max(m.running[2], 1) * 100, m.running[1].item()
+        test_acc, test_loss = m.eval_sums[0] / max(num_examples, 1) * 100, m.eval_sums[1]
+        m.print('Epoch{},train_acc,{:.2f}%,train_loss,{:.8f},valid_acc,{:.2f}%,valid_loss,{:.8f}'.format(
+            epoch, train_acc, train_loss, test_acc, test_loss))
+        m.controller.after_epoch()
+        if m.controller.update(test_acc, test_loss):
+            if SAVE_BEST_MODEL:
+                torch.save(m.model.state_dict(), m.checkpoint)
+            m.print('best epoch {}, train_acc {}, test_acc {}'.format(epoch, train_acc, test_acc))
+        m.reset()
+        m.model.train()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Train several classifiers on one shared data stream')
+    parser.add_argument('--rnn', type=lambda s: s.split(','), default=list(RNNS))
+    parser.add_argument('--layers', type=int, default=N_LAYERS_RNN)
+    parser.add_argument('--hidden-dim', type=int, default=HIDDEN_DIM)
+    parser.add_argument('--lr', type=float, default=LR)
+    parser.add_argument('--max-epoch', type=int, default=MAX_EPOCH)
+    parser.add_argument('--device', default=DEVICES, help="GPU index or 'cpu'")
+    parser.add_argument('--threads', type=int, default=THREADS)
+    args = parser.parse_args(argv[1:])
+    for rnn in args.rnn:
+        if rnn not in MODELS:
+            parser.error('unknown model {!r}, expected one of {}'.format(rnn, ', '.join(MODELS)))
+
+    device = setup_device(int(args.device) if str(args.device).isdigit() else args.device, args.threads)
+    if not os.path.isdir(LOG_DIR):
+        os.makedirs(LOG_DIR)
+    members = [Member(rnn, device, args.hidden_dim, args.layers, args.lr, LOG_DIR, name)
+               for rnn, name in zip(args.rnn, member_names(args.rnn, args.layers))]
+
+    # one padded batch serves every model: the recurrent ones pack it themselves (model.pack_input)
+    collate_fn = PadCollate(packed=False)
+    dataset_train = LandmarkList(root=DATA_ROOT, fileList=TRAIN_LIST)
+    dataloader_train = data.DataLoader(dataset_train, batch_size=BATCH_SIZE, shuffle=True, num_workers=0, collate_fn=collate_fn)
+    dataset_test = LandmarkList(root=DATA_ROOT, fileList=TEST_LIST)
+    dataloader_test = data.DataLoader(dataset_test, batch_size=64, shuffle=False, num_workers=0, collate_fn=collate_fn)
+    prefetch_train = Prefetcher(dataloader_train, device, depth=PREFETCH_BATCHES)
+    prefetch_test = Prefetcher(dataloader_test, device, depth=PREFETCH_BATCHES)
+
+    for epoch in range(args.max_epoch):
+        active = [m for m in members if not m.controller.stopped]
+        if not active:
+            break
+        for m in active:
+            m.model.train()
+        epoch_start = time.time()
+        for batch, labels, lengths in prefetch_train:
+            for m in active:
+                m.train_step(batch, labels, lengths)
+        print('train ' + prefetch_train.report(time.time() - epoch_start))
+        validate(active, prefetch_test, epoch)
+    for m in members:
+        m.print(m.controller.report() + ', {:.0f}s in training steps'.format(m.seconds))
+        m.log.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)